@@ -0,0 +1,67 @@
+import importlib
+import sys
+import threading
+import types
+
+# Serializes the heavy imports of the warm-up thread and of the page
+# scripts. Two threads importing overlapping module graphs in different
+# orders can otherwise make Python's deadlock avoidance hand one of them a
+# partially initialized module.
+_IMPORT_LOCK = threading.RLock()
+
+
+def import_module(name):
+    """
+    Import a module while holding the shared import lock
+    """
+    with _IMPORT_LOCK:
+        return importlib.import_module(name)
+
+
+class _LazyModule(types.ModuleType):
+    """
+    Placeholder that imports the real module on first attribute access
+
+    Nothing is registered in sys.modules before the real module is fully
+    imported, so other imports never observe a partially initialized
+    placeholder.
+    """
+
+    def __init__(self, name):
+        super().__init__(name)
+        self.__dict__['_lazy_module'] = None
+
+    def _load(self):
+        module = self.__dict__['_lazy_module']
+        if module is None:
+            module = import_module(self.__name__)
+            self.__dict__['_lazy_module'] = module
+        return module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __dir__(self):
+        return dir(self._load())
+
+
+def lazy_import(name):
+    """
+    Return a module that is only imported on first attribute access
+
+    Parameters:
+    -----------
+    name : str
+        Full module name, e.g. 'scipy.optimize' or 'matplotlib.pyplot'
+
+    Returns:
+    --------
+    module
+        The module itself if it is already fully imported, otherwise a
+        thread-safe placeholder that imports it on first use
+    """
+    module = sys.modules.get(name)
+    if module is not None and not getattr(getattr(module, '__spec__', None),
+                                          '_initializing', False):
+        return module
+    return _LazyModule(name)
@@ -1,14 +1,24 @@
 import io
 import json
 import streamlit as st
-import pandas as pd
 import numpy as np
-import seaborn as sns
-import matplotlib.pyplot as plt
+from lazy_imports import lazy_import
 from utility import (
-    fit_function, upper_function, lower_function,
-    process_data, get_plot_defaults
+    FIT_MODELS, upper_function, lower_function,
+    process_data, fit_preliminary, compare_fit_results,
+    calc_local_spacing, calc_phasing_significance, get_plot_defaults,
+    read_phasing_table, read_aggregated_table, validate_upload,
+    show_upload_report, dataframe_to_parquet_bytes, prepare_results_for_json,
+    UPLOAD_TYPES
 )
+from shared_cache import get_shared_cache, get_session_id, content_key, upload_key
+from startup import EXAMPLE_PHASING, example_data_key, fit_cache_key, setup_page
+
+pd = lazy_import('pandas')
+sns = lazy_import('seaborn')
+plt = lazy_import('matplotlib.pyplot')
+
+setup_page()
 
 
 def plot_settings_sidebar():
@@ -41,6 +51,28 @@ def plot_settings_sidebar():
         xlim_max = st.number_input("X Max", value=defaults['xlim'][1])
         ylim_max = st.number_input("Y Max", value=defaults['ylim'][1])
         xtick_max = st.number_input("X tick Max", value=defaults['xticks_popt'][1])        
+    # Candidate models
+    st.sidebar.subheader("Model Selection")
+    models = st.sidebar.multiselect(
+        "Candidate Models",
+        options=list(FIT_MODELS),
+        default=['full'],
+        format_func=lambda m: FIT_MODELS[m]['label'],
+        help="With more than one model, all are fitted and ranked by the criterion"
+    )
+    criterion = st.sidebar.selectbox("Criterion", options=['BIC', 'AIC'], index=0)
+    multistart = st.sidebar.checkbox(
+        "Multi-start fitting", value=False,
+        help="Score a grid of spacing/phase/decay starts and refine the best ones")
+    progressive = st.sidebar.checkbox(
+        "Progressive fitting", value=False,
+        help="Show a preliminary fit on per-position means first, then refine on the full data")
+    latency_budget = 1.0
+    if progressive:
+        latency_budget = st.sidebar.number_input(
+            "Preliminary Latency Target (s)", value=1.0, min_value=0.1, step=0.5,
+            help="The preliminary fit uses the finest aggregation that fits this target")
+
     # Combine all parameters
     plot_params = {
         'title': title,
@@ -50,7 +82,12 @@ def plot_settings_sidebar():
         'ylim': [ylim_min, ylim_max],
         'location_range': [pos_min, pos_max],
         'xticks': np.arange(xtick_min, xtick_max+1, xtick_space),
-        'yticks': np.arange(ylim_min, ylim_max*1.05, (ylim_max - ylim_min) / 5)
+        'yticks': np.arange(ylim_min, ylim_max*1.05, (ylim_max - ylim_min) / 5),
+        'models': models,
+        'criterion': criterion,
+        'multistart': multistart,
+        'progressive': progressive,
+        'latency_budget': latency_budget,
     }
     
     return plot_params
@@ -76,9 +113,10 @@ def create_visualization(df, result_dict, plot_params):
         # Get fit parameters
         popt = result_dict['fit_params']
         A_fit, l_fit, w_0_fit, theta0_fit, b_fit, s_fit = popt
+        model = FIT_MODELS[result_dict.get('Model', 'full')]
         
-        # Plot fitted sine wave
-        y_fit = fit_function(x_fit, A_fit, l_fit, w_0_fit, theta0_fit, b_fit, s_fit)
+        # Plot fitted curve of the selected model
+        y_fit = model['function'](x_fit, *result_dict.get('model_params', popt))
         g = sns.lineplot(x=x_fit, y=y_fit, label='Fitted', ax=g, color='red', lw=1)
         
         # Plot envelopes
@@ -102,6 +140,24 @@ def create_visualization(df, result_dict, plot_params):
     g.legend(markerscale=2)
     return fig
 
+def create_local_spacing_plot(local_df, plot_params):
+    """
+    Create plot of local spacing and amplitude versus position
+    """
+    fig, (ax1, ax2) = plt.subplots(2, 1, figsize=(5, 5), sharex=True)
+    sns.lineplot(x=local_df['Pos'], y=local_df['Spacing'], color='red', lw=1,
+                 marker='o', markersize=3, ax=ax1)
+    ax1.set(ylabel='Local Spacing (bp)',
+            title=plot_params['title'] + ' (Sliding Window)')
+    sns.lineplot(x=local_df['Pos'], y=local_df['Amplitude'], color='.3', lw=1,
+                 marker='o', markersize=3, ax=ax2)
+    ax2.set(xlabel=plot_params['xlabel'],
+            ylabel='Local Amplitude',
+            xlim=plot_params['xlim'],
+            xticks=plot_params['xticks'])
+    fig.tight_layout()
+    return fig
+
 def save_figure_to_bytes(fig, format='png', dpi=300):
     """Save matplotlib figure to bytes in specified format"""
     buf = io.BytesIO()
@@ -109,18 +165,6 @@ def save_figure_to_bytes(fig, format='png', dpi=300):
     buf.seek(0)
     return buf
 
-def prepare_results_for_json(result_dict):
-    """Convert numpy values to Python native types for JSON serialization"""
-    json_safe_dict = {}
-    for key, value in result_dict.items():
-        if isinstance(value, np.ndarray):
-            json_safe_dict[key] = value.tolist()
-        elif isinstance(value, np.float64):
-            json_safe_dict[key] = float(value)
-        else:
-            json_safe_dict[key] = value
-    return json_safe_dict
-
 def prepare_results_for_csv(result_dict):
     """Convert results dictionary to 2-column format for CSV"""
     metrics = []
@@ -138,6 +182,11 @@ def prepare_results_for_csv(result_dict):
         ['Phase (rad)', f"{result_dict['theta0']:.2f}"],
         ['Baseline (b0)', f"{result_dict['b0']:.3f}"]
     ])
+    if 'P_value' in result_dict:
+        metrics.extend([
+            ['Phasing p-value', f"{result_dict['P_value']:.4f}"],
+            ['Surrogates', f"{result_dict['N_surrogates']}"]
+        ])
     
     # Create DataFrame
     results_df = pd.DataFrame(metrics, columns=['Metric', 'Value'])
@@ -169,50 +218,123 @@ def display_fit_results(result_dict):
                  f"{result_dict['Slope']:.2f} ± {result_dict['Error_Slope']:.2f}")
         st.metric("Phase (rad)", 
                  f"{result_dict['theta0']:.2f}")    
+    if 'P_value' in result_dict:
+        st.metric("Phasing p-value",
+                  f"{result_dict['P_value']:.4f}",
+                  help=f"{result_dict['Method']} surrogates: {result_dict['N_surrogates']}")
 
-def load_example_data():
+def load_example_data(location_range=None):
     """Load example phasing data from file"""
-    try:
-        return pd.read_csv('data/example_phasing.csv')
-    except Exception as e:
-        st.error(f"Error loading example data: {str(e)}")
-        return None
+    return read_phasing_table(EXAMPLE_PHASING,
+                              columns=('Pos', 'Value'),
+                              location_range=location_range)
         
 
 def main():
     st.title("Phasing Analysis")
-    st.markdown("Upload CSV file containing phasing data for analysis.")
+    st.markdown("Upload a CSV, Parquet, Arrow or Feather file containing phasing data for analysis.")
     
     # Get plot settings from sidebar
     plot_params = plot_settings_sidebar()
     
+    # Data and fits are shared between sessions through the process-wide cache
+    cache = get_shared_cache()
+    session_id = get_session_id()
+
     # Add example data option
     use_example = st.checkbox("Use example data", value=False)
     
     if use_example:
-        df = load_example_data()
+        data_key = example_data_key(plot_params['location_range'])
+        df = cache.get_or_compute(
+            data_key, lambda: load_example_data(plot_params['location_range']), session_id)
         if df is not None:
-            st.success("Using example data from data/example_phasing.csv")
+            st.success(f"Using example data from {EXAMPLE_PHASING}")
     else:
         # File uploader
         uploaded_file = st.file_uploader(
-            "Choose a CSV file (required columns: Pos, Value)",
-            type="csv",
-            help="CSV should contain columns: Pos, Value"
+            "Choose a CSV, Parquet, Arrow or Feather file (required columns: Pos, Value)",
+            type=UPLOAD_TYPES,
+            help="File should contain columns: Pos, Value"
         )
         
         if uploaded_file is None:
-            st.info("Please upload a CSV file or use the example data.")
+            st.info("Please upload a file or use the example data.")
+            return
+        # Check header and a sample before parsing the whole file
+        report = validate_upload(uploaded_file, columns=('Pos', 'Value'),
+                                 location_range=plot_params['location_range'])
+        if not show_upload_report(report):
             return
-        df = pd.read_csv(uploaded_file)
+        data_key = content_key(upload_key(uploaded_file), plot_params['location_range'],
+                               report['large'])
+        if report['large']:
+            st.info("Large file: streaming it into per-position means before fitting. "
+                    "The fit is weighted by the rows per position; R², AIC and BIC are "
+                    "computed on the position means.")
+            df = cache.get_or_compute(data_key, lambda: read_aggregated_table(
+                uploaded_file, plot_params['location_range']), session_id)
+        else:
+            df = cache.get_or_compute(data_key, lambda: read_phasing_table(
+                uploaded_file, columns=('Pos', 'Value'),
+                location_range=plot_params['location_range']), session_id)
     
     if df is not None:      
         # Process data with specified range
         xmin, xmax = plot_params['location_range']
-        processed_result = process_data(df, xmin=xmin, xmax=xmax)
+        models = plot_params['models']
+        if len(models) == 0:
+            st.warning(f"No candidate model selected; fitting {FIT_MODELS['full']['label']}.")
+        fit_options = {
+            # The default model keeps the options (and cache keys) of the warm-up fit
+            'models': None if models in ([], ['full']) else models,
+            'criterion': plot_params['criterion'],
+            'multistart': plot_params['multistart'],
+        }
+
+        # A progressive result is warm-started from its preliminary fit, so it
+        # is cached apart from the exact fit of the same options
+        key_options = dict(fit_options)
+        if plot_params['progressive']:
+            key_options.update(progressive=True, latency_budget=plot_params['latency_budget'])
+        fit_key = fit_cache_key(data_key, xmin, xmax, key_options)
+        processed_result = cache.get(fit_key, session_id)
+
+        # Preliminary fit on per-position means, shown while the full fit runs
+        prelim_result = None
+        if plot_params['progressive'] and processed_result is None:
+            prelim = fit_preliminary(df, xmin=xmin, xmax=xmax,
+                                     latency_budget=plot_params['latency_budget'],
+                                     **fit_options)
+            if prelim is not None:
+                agg_df, prelim_result, prelim_info = prelim
+                preview = st.empty()
+                with preview.container():
+                    st.subheader("Fitting Results (Preliminary)")
+                    st.caption(f"Fitted on {prelim_info['Points']} per-position means "
+                               f"({prelim_info['Levels']} levels) in {prelim_info['Elapsed']:.2f} s "
+                               f"of a {prelim_info['Budget']:.1f} s target; "
+                               "refining on the full data...")
+                    display_fit_results(prelim_result)
+                    st.pyplot(create_visualization(agg_df, prelim_result, plot_params))
+
+        if processed_result is None:
+            processed_result = process_data(df.copy(), xmin=xmin, xmax=xmax,
+                                            start_result=prelim_result, **fit_options)
+            if processed_result is not None and processed_result[1] is not None:
+                if prelim_result is not None and 'Model_Ranking' in prelim_result:
+                    # The warm-started final fit only refits the preliminary winner
+                    processed_result[1]['Preliminary_Model_Ranking'] = \
+                        prelim_result['Model_Ranking']
+                processed_result = cache.put(fit_key, processed_result, session_id)
+        if prelim_result is not None:
+            preview.empty()
         
         if processed_result is not None:
             processed_df, result_dict = processed_result
+            # Per-session copy: the cached result is shared with other sessions
+            if result_dict is not None:
+                result_dict = dict(result_dict)
             # Save to session state with a specific key
             st.session_state['phasing_results'] = {
                 'results': result_dict,
@@ -222,9 +344,47 @@ def main():
             st.subheader("Data Preview")
             st.dataframe(processed_df.head(), use_container_width=True)
             
+            # Optional surrogate significance test
+            st.sidebar.header("Significance Test")
+            run_test = st.sidebar.checkbox("Compute phasing p-value", value=False)
+            if run_test and result_dict is not None:
+                n_surrogates = st.sidebar.number_input(
+                    "Surrogate Count", value=1000, min_value=99, step=100)
+                method = st.sidebar.selectbox(
+                    "Surrogate Method", options=['phase', 'permutation'], index=0)
+                test_key = content_key(fit_key, 'significance', method,
+                                       int(n_surrogates), 0)
+                test_result = cache.get_or_compute(test_key, lambda: calc_phasing_significance(
+                    processed_df, result_dict, n_surrogates=int(n_surrogates),
+                    method=method, seed=0), session_id)
+                if test_result is not None:
+                    result_dict.update(test_result)
+
             # Display fitting results
-            st.subheader("Fitting Results")
+            if prelim_result is not None:
+                st.subheader("Fitting Results (Final)")
+            else:
+                st.subheader("Fitting Results")
             display_fit_results(result_dict)
+            if prelim_result is not None and result_dict is not None:
+                st.markdown("**Change from preliminary fit**")
+                st.dataframe(compare_fit_results(prelim_result, result_dict),
+                             use_container_width=True)
+            if result_dict is not None and 'Start_Index' in result_dict:
+                st.caption(f"Multi-start: start #{result_dict['Start_Index'] + 1} won "
+                           f"after {result_dict['N_Refinements']} refinements")
+            if result_dict is not None and 'Model_Ranking' in result_dict:
+                st.markdown(f"**Selected model:** {FIT_MODELS[result_dict['Model']]['label']}")
+                st.dataframe(pd.DataFrame(result_dict['Model_Ranking']),
+                             use_container_width=True)
+            elif result_dict is not None and 'Preliminary_Model_Ranking' in result_dict:
+                st.markdown(f"**Selected model:** {FIT_MODELS[result_dict['Model']]['label']}")
+                st.caption("Models were ranked by the preliminary fit on per-position means; "
+                           "the final fit refines the winning model only.")
+                st.dataframe(pd.DataFrame(result_dict['Preliminary_Model_Ranking']),
+                             use_container_width=True)
+            elif result_dict is not None and result_dict['Model'] != 'full':
+                st.markdown(f"**Fitted model:** {FIT_MODELS[result_dict['Model']]['label']}")
             
             # Create visualization
             fig = create_visualization(processed_df, result_dict, plot_params)
@@ -233,6 +393,27 @@ def main():
             st.subheader("Phasing Analysis Plot")
             st.pyplot(fig)
             
+            # Sliding-window local spacing
+            st.subheader("Local Spacing Profile")
+            use_local = st.checkbox("Run sliding-window analysis", value=False)
+            if use_local:
+                col_w, col_s = st.columns(2)
+                with col_w:
+                    window = st.number_input("Window (bp)", value=400, min_value=100, step=50)
+                with col_s:
+                    step = st.number_input("Step (bp)", value=20, min_value=1, step=5)
+                local_df = calc_local_spacing(processed_df, result_dict,
+                                              window=int(window), step=int(step))
+                if local_df is not None:
+                    st.pyplot(create_local_spacing_plot(local_df, plot_params))
+                    st.dataframe(local_df, use_container_width=True)
+                    st.download_button(
+                        label="Download Local Spacing (CSV)",
+                        data=local_df.to_csv(index=False).encode('utf-8'),
+                        file_name='local_spacing.csv',
+                        mime='text/csv'
+                    )
+
             # Download section
             st.subheader("Download Options")
             col1, col2, col3 = st.columns(3)
@@ -245,6 +426,12 @@ def main():
                     file_name='processed_data.csv',
                     mime='text/csv'
                 )
+                st.download_button(
+                    label="Download Processed Data (Parquet)",
+                    data=dataframe_to_parquet_bytes(processed_df),
+                    file_name='processed_data.parquet',
+                    mime='application/octet-stream'
+                )
             
             # Download results
             with col2:
@@ -254,7 +441,7 @@ def main():
                 with col21:
                     st.download_button(
                         label="Download Results (JSON)",
-                        data=json.dumps(json_safe_results, indent=2),
+                        data=json.dumps(json_safe_results, indent=2, allow_nan=False),
                         file_name='fitting_results.json',
                         mime='application/json'
                     )
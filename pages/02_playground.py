@@ -1,14 +1,18 @@
 import streamlit as st
 import numpy as np
-import matplotlib.pyplot as plt
-import seaborn as sns
-from utility import fit_function, upper_function, lower_function, get_plot_defaults
-
-st.set_page_config(
-    page_title="Curve Fit Playground",
-    page_icon="🎮",
-    layout="wide"
+from lazy_imports import lazy_import
+from utility import (
+    fit_function, upper_function, lower_function, get_plot_defaults,
+    sweep_curves, SWEEP_PARAMETERS
 )
+from startup import setup_page
+
+pd = lazy_import('pandas')
+alt = lazy_import('altair')
+sns = lazy_import('seaborn')
+plt = lazy_import('matplotlib.pyplot')
+
+setup_page("Curve Fit Playground", "🎮")
 
 def create_parameter_controls(phasing_results=None):
     """Create sliders for parameter adjustment"""
@@ -31,6 +35,9 @@ def create_parameter_controls(phasing_results=None):
         return params
 
     result_dict = phasing_results['results']
+    if result_dict.get('Model', 'full') == 'two_freq':
+        st.warning("The loaded fit has a second frequency component; the controls "
+                   "start from its main component only")
     spacing = st.number_input('Spacing', value=result_dict['Spacing'])
     w = 2 * np.pi / spacing
     amp =  st.number_input('Amplitude', value=result_dict['Amplitude'])
@@ -124,6 +131,117 @@ def plot_curves(params, plot_params):
 
     return fig
 
+@st.cache_data(show_spinner=False, max_entries=64)
+def compute_curves(A, l, w_0, theta_0, b, s, xlim, n_points=1000):
+    """Precompute the fitted curve, baseline and envelopes on the x grid"""
+    x = np.linspace(xlim[0], xlim[1], n_points)
+    return pd.DataFrame({
+        'x': x,
+        'Fitted': fit_function(x, A, l, w_0, theta_0, b, s),
+        'BaseLine': b + s * x,
+        'Upper Envelope': upper_function(x, A, l, b, s),
+        'Lower Envelope': lower_function(x, A, l, b, s),
+    })
+
+def plot_curves_fast(params, plot_params):
+    """Create a lightweight interactive chart of the precomputed curves"""
+    curve_df = compute_curves(params['A'], params['l'], params['w_0'],
+                              params['theta_0'], params['b'], params['s'],
+                              tuple(plot_params['xlim']))
+    long_df = curve_df.melt('x', var_name='Curve', value_name='y')
+    chart = alt.Chart(long_df).mark_line(clip=True).encode(
+        x=alt.X('x:Q', title=plot_params['xlabel'],
+                scale=alt.Scale(domain=list(plot_params['xlim']))),
+        y=alt.Y('y:Q', title=plot_params['ylabel'],
+                scale=alt.Scale(domain=list(plot_params['ylim']))),
+        color=alt.Color('Curve:N', scale=alt.Scale(
+            domain=['Fitted', 'BaseLine', 'Upper Envelope', 'Lower Envelope'],
+            range=['red', '#4d4d4d', '#808080', '#808080'])),
+        strokeDash=alt.condition(alt.datum.Curve == 'Fitted',
+                                 alt.value([1, 0]), alt.value([6, 4])),
+    ).properties(title=plot_params['title'], height=400)
+    return chart
+
+def sweep_controls(params):
+    """Create controls for the parameter sweep"""
+    spacing = 2 * np.pi / params['w_0']
+    base = {
+        'Spacing': spacing,
+        'Decay': float(np.exp(-params['l'] * spacing)),
+        'Amplitude': params['A'],
+        'theta0': params['theta_0'],
+    }
+    sweep = st.selectbox("Swept Parameter", options=SWEEP_PARAMETERS)
+    # Phases are swept around the current value, the others relative to it
+    if sweep == 'theta0':
+        default_range = (base[sweep] - np.pi / 2, base[sweep] + np.pi / 2)
+    else:
+        default_range = (base[sweep] * 0.8, base[sweep] * 1.2)
+    col1, col2, col3 = st.columns(3)
+    with col1:
+        low = st.number_input("From", value=float(default_range[0]))
+    with col2:
+        high = st.number_input("To", value=float(default_range[1]))
+    with col3:
+        n_values = st.number_input("Curves", value=9, min_value=2, max_value=200)
+    mode = st.radio("Display", options=['Overlay', 'Heatmap'], horizontal=True)
+    if low == high:
+        st.warning("From and To must differ to sweep a parameter.")
+        return None
+    for name in ('Spacing', 'Decay'):
+        lowest = min(low, high) if name == sweep else base[name]
+        if not lowest > 0:
+            st.warning(f"{name} must be positive over the whole sweep.")
+            return None
+    return base, sweep, np.linspace(low, high, int(n_values)), mode
+
+def plot_sweep(params, base, sweep, values, mode, plot_params):
+    """Plot the family of curves (with their envelopes in overlay mode) of a parameter sweep"""
+    overlay = mode == 'Overlay'
+    n_points = 1000 if overlay else 300
+    x = np.linspace(plot_params['xlim'][0], plot_params['xlim'][1], n_points)
+    curves = sweep_curves(x, base['Spacing'], base['Amplitude'], base['Decay'],
+                          base['theta0'], params['b'], params['s'], sweep, values,
+                          envelopes=overlay)
+    if overlay:
+        names = {'fit': 'Fitted', 'upper': 'Upper Envelope', 'lower': 'Lower Envelope'}
+        long_df = pd.concat([pd.DataFrame({
+            'x': np.tile(x, len(values)),
+            sweep: np.repeat(values, len(x)),
+            'y': curves[key].ravel(),
+            'Curve': name,
+        }) for key, name in names.items()], ignore_index=True)
+        chart = alt.Chart(long_df).mark_line(clip=True, strokeWidth=1).encode(
+            x=alt.X('x:Q', title=plot_params['xlabel'],
+                    scale=alt.Scale(domain=list(plot_params['xlim']))),
+            y=alt.Y('y:Q', title=plot_params['ylabel'],
+                    scale=alt.Scale(domain=list(plot_params['ylim']))),
+            color=alt.Color(f'{sweep}:Q', scale=alt.Scale(scheme='viridis')),
+            strokeDash=alt.StrokeDash('Curve:N', scale=alt.Scale(
+                domain=list(names.values()), range=[[1, 0], [6, 4], [6, 4]]), legend=None),
+            detail=[f'{sweep}:Q', 'Curve:N'],
+        )
+    else:
+        long_df = pd.DataFrame({
+            'x': np.tile(x, len(values)),
+            sweep: np.repeat(values, len(x)),
+            'y': curves['fit'].ravel(),
+        })
+        dx = x[1] - x[0]
+        dv = values[1] - values[0]
+        long_df['x2'] = long_df['x'] + dx
+        long_df[f'{sweep}_end'] = long_df[sweep] + dv
+        chart = alt.Chart(long_df).mark_rect().encode(
+            x=alt.X('x:Q', title=plot_params['xlabel'],
+                    scale=alt.Scale(domain=list(plot_params['xlim']))),
+            x2='x2:Q',
+            y=alt.Y(f'{sweep}:Q', title=sweep),
+            y2=f'{sweep}_end:Q',
+            color=alt.Color('y:Q', title=plot_params['ylabel'],
+                            scale=alt.Scale(scheme='redblue', reverse=True)),
+        )
+    return chart.properties(title=f"{plot_params['title']}: {sweep} sweep", height=400)
+
 def main():
     st.title("Curve Playground")
     st.markdown("""
@@ -146,8 +264,22 @@ def main():
     
     # Plot in right column
     with col2:
-        fig = plot_curves(params, plot_params)
-        st.pyplot(fig)
+        renderer = st.radio("Renderer", options=['Interactive (fast)', 'Matplotlib'],
+                            horizontal=True)
+        if renderer == 'Matplotlib':
+            fig = plot_curves(params, plot_params)
+            st.pyplot(fig)
+        else:
+            st.altair_chart(plot_curves_fast(params, plot_params), use_container_width=True)
+
+    # Parameter sweep
+    st.subheader("Parameter Sweep")
+    if st.checkbox("Sweep one parameter", value=False):
+        sweep_settings = sweep_controls(params)
+        if sweep_settings is not None:
+            base, sweep, values, mode = sweep_settings
+            st.altair_chart(plot_sweep(params, base, sweep, values, mode, plot_params),
+                            use_container_width=True)
     
 
 if __name__ == "__main__":
@@ -1,13 +1,26 @@
 import streamlit as st
 import io
 import numpy as np
-import matplotlib.pyplot as plt
-import seaborn as sns
-import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+from lazy_imports import lazy_import
 from utility import (
-    fit_function, upper_function, lower_function,
-    process_data, process_gene_data, get_plot_defaults
+    FIT_MODELS, population_model, upper_function, lower_function,
+    process_data, process_gene_data, estimate_gene_spacing_spectral,
+    cluster_gene_profiles, build_gene_matrix, calculate_adj_gene_matrix,
+    heatmap_row_order, build_heatmap_pyramid, select_heatmap_tile,
+    build_sort_index, gene_table_mask, query_gene_table,
+    get_plot_defaults, read_phasing_table, validate_upload, show_upload_report,
+    dataframe_to_parquet_bytes, UPLOAD_TYPES
 )
+from shared_cache import get_shared_cache, get_session_id, content_key, upload_key
+from startup import setup_page
+
+pd = lazy_import('pandas')
+sns = lazy_import('seaborn')
+plt = lazy_import('matplotlib.pyplot')
+mpl_figure = lazy_import('matplotlib.figure')
+
+setup_page()
 
 def plot_settings_sidebar():
     """
@@ -70,12 +83,11 @@ def create_visualization(df, fit_results, gene, adj_value, plot_params):
         # Generate fitting curve points
         x_fit = np.linspace(plot_params['xlim'][0], plot_params['xlim'][1], 1000)
         
-        # Get fit parameters
-        popt = fit_results['results']['fit_params']
-        A_fit, l_fit, w_0_fit, theta0_fit, b_fit, s_fit = popt
+        # Get the population model and its parameters
+        model, popt = population_model(fit_results)
         
         # Plot fitted sine wave
-        y_fit = fit_function(x_fit, A_fit, l_fit, w_0_fit, theta0_fit, b_fit, s_fit)
+        y_fit = FIT_MODELS[model]['function'](x_fit, *popt)
         g = sns.lineplot(x=x_fit, y=y_fit, label='Population Fitted Curve', ax=g, color='red', lw=1)
 
         y_fit_adj = y_fit + adj_value
@@ -100,6 +112,149 @@ def save_figure_to_bytes(fig, format='png', dpi=300):
     buf.seek(0)
     return buf
 
+def create_cluster_plot(profile_df, fit_results, plot_params):
+    """
+    Create plot of the average profile of each gene cluster
+    """
+    fig, ax = plt.subplots(figsize=(5, 4))
+    labels = profile_df['Cluster'].astype(str) + ' (' + profile_df['Genes'].astype(str) + ' genes)'
+    g = sns.lineplot(x=profile_df['Pos'], y=profile_df['Value'], hue=labels, lw=1, ax=ax)
+    x_fit = np.linspace(plot_params['xlim'][0], plot_params['xlim'][1], 1000)
+    model, popt = population_model(fit_results)
+    y_fit = FIT_MODELS[model]['function'](x_fit, *popt)
+    g = sns.lineplot(x=x_fit, y=y_fit, label='Population Fitted Curve', ax=g,
+                     color='.4', lw=1, ls='--')
+    g.set(xlabel=plot_params['xlabel'],
+          ylabel=plot_params['ylabel'],
+          xlim=plot_params['xlim'],
+          ylim=plot_params['ylim'],
+          xticks=plot_params['xticks'],
+          yticks=plot_params['yticks'],
+          title=plot_params['title'] + ' Gene Clusters')
+    g.legend(title='Cluster', fontsize='small')
+    return fig
+
+def draw_heatmap(fig, tile, positions, color_range, plot_params, title):
+    """
+    Draw a heatmap tile (from select_heatmap_tile) on a matplotlib figure
+    """
+    ax = fig.add_subplot()
+    data = tile['data']
+    x0 = positions[0] - 0.5
+    y1 = tile['row_start'] + data.shape[0] * tile['row_step']
+    image = ax.imshow(data, aspect='auto', interpolation='none',
+                      cmap=color_range['cmap'], vmin=color_range['vmin'], vmax=color_range['vmax'],
+                      extent=(x0, x0 + data.shape[1] * tile['col_step'], y1, tile['row_start']))
+    ax.set(xlabel=plot_params['xlabel'],
+           ylabel='Genes',
+           xlim=plot_params['xlim'],
+           ylim=(tile['row_stop'], tile['row_start']),
+           xticks=plot_params['xticks'],
+           title=title)
+    fig.colorbar(image, ax=ax, label=color_range['label'])
+    return fig
+
+def render_heatmap_pdf(tile, positions, color_range, plot_params, title):
+    """Render a full-resolution heatmap tile to PDF bytes (safe off the main thread)"""
+    fig = mpl_figure.Figure(figsize=(8, 11))
+    draw_heatmap(fig, tile, positions, color_range, plot_params, title)
+    buf = io.BytesIO()
+    fig.savefig(buf, format='pdf', bbox_inches='tight')
+    return buf.getvalue()
+
+@st.cache_resource
+def get_export_executor():
+    """Background worker shared by all sessions for full-resolution exports"""
+    return ThreadPoolExecutor(max_workers=1, thread_name_prefix='heatmap-export')
+
+def heatmap_matrix(df, phasing_results, xmin, xmax, residual):
+    """Gene x position matrix of values, or of residuals against the population fit"""
+    genes, positions, matrix = build_gene_matrix(df, xmin=xmin, xmax=xmax)
+    if residual:
+        model, popt = population_model(phasing_results)
+        matrix = calculate_adj_gene_matrix(positions, matrix, popt, model)[0]
+    return genes, positions, matrix
+
+def heatmap_export_status():
+    """Show the state of the background PDF export, polling while it runs"""
+    job = st.session_state.get('heatmap_export')
+    if job is None:
+        return
+    future = job['future']
+    if not future.done():
+        st.info(f"Rendering full-resolution PDF of {job['n_rows']:,} genes...")
+        return
+    if job['polling']:
+        # Rerun the whole page so the fragment is registered without polling
+        job['polling'] = False
+        st.rerun(scope='app')
+    if future.exception() is not None:
+        st.error(f"PDF export failed: {str(future.exception())}")
+        return
+    st.download_button(
+        label="Download Heatmap (PDF)",
+        data=future.result(),
+        file_name='gene_heatmap.pdf',
+        mime='application/pdf'
+    )
+
+def gene_heatmap_view(df, gene_df, phasing_results, gene_key, plot_params, cache, session_id):
+    """
+    Show genes sorted by phasing as a heatmap rendered from a resolution pyramid
+    """
+    st.sidebar.header("Gene Heatmap")
+    if not st.sidebar.checkbox("Show gene heatmap", value=False):
+        return
+    sort_options = ['Adj.Average', 'R2'] + (['Cluster'] if 'Cluster' in gene_df.columns else [])
+    sort_by = st.sidebar.selectbox("Sort Heatmap by", options=sort_options)
+    descending = st.sidebar.checkbox("Descending", value=True, key='heatmap_descending')
+    values = st.sidebar.radio("Heatmap Values", options=['Value', 'Residual'], horizontal=True)
+    height = st.sidebar.number_input("Heatmap Height (px)", value=600, min_value=200, step=100)
+    xmin, xmax = plot_params['location_range']
+
+    matrix_key = content_key(gene_key, 'heatmap', values)
+    genes, positions, matrix = cache.get_or_compute(matrix_key, lambda: heatmap_matrix(
+        df, phasing_results, xmin, xmax, values == 'Residual'), session_id)
+    rows = heatmap_row_order(gene_df, genes, sort_by=sort_by, ascending=not descending)
+    pyramid = cache.get_or_compute(content_key(matrix_key, rows),
+                                   lambda: build_heatmap_pyramid(matrix, rows), session_id)
+
+    n_rows = len(rows)
+    row_range = st.sidebar.slider("Gene Rows", min_value=1, max_value=max(n_rows, 2),
+                                  value=(1, max(n_rows, 2)),
+                                  help="Zoom into a range of the sorted genes")
+    tile = select_heatmap_tile(pyramid, row_range[0] - 1, row_range[1], max_rows=int(height))
+
+    # Color scale from the coarsest level, symmetric for residuals
+    low, high = np.nanpercentile(pyramid[-1]['data'], [2, 98])
+    if values == 'Residual':
+        bound = max(abs(low), abs(high))
+        color_range = {'cmap': 'RdBu_r', 'vmin': -bound, 'vmax': bound, 'label': 'Residual'}
+    else:
+        color_range = {'cmap': 'viridis', 'vmin': low, 'vmax': high, 'label': plot_params['ylabel']}
+    title = plot_params['title'] + f' Genes Sorted by {sort_by}'
+
+    st.subheader("Gene Heatmap")
+    fig = plt.figure(figsize=(8, height / 100))
+    st.pyplot(draw_heatmap(fig, tile, positions, color_range, plot_params, title))
+    plt.close(fig)
+    st.caption(f"Genes {tile['row_start'] + 1:,}-{tile['row_stop']:,} of {n_rows:,}, "
+               f"pyramid level {tile['level']} (cells of {tile['row_step']} x "
+               f"{tile['col_step']} genes x bp)")
+
+    if st.button("Export Full-Resolution PDF"):
+        full_tile = select_heatmap_tile(pyramid, row_range[0] - 1, row_range[1],
+                                        max_rows=n_rows, max_cols=matrix.shape[1])
+        st.session_state['heatmap_export'] = {
+            'n_rows': full_tile['row_stop'] - full_tile['row_start'],
+            'polling': True,
+            'future': get_export_executor().submit(
+                render_heatmap_pdf, full_tile, positions, color_range, plot_params, title),
+        }
+    job = st.session_state.get('heatmap_export')
+    run_every = 2 if job is not None and job['polling'] else None
+    st.fragment(run_every=run_every)(heatmap_export_status)()
+
 def load_example_data():
     """Load example phasing data from file"""
     try:
@@ -108,6 +263,54 @@ def load_example_data():
         st.error(f"Error loading example data: {str(e)}")
         return None
 
+@st.cache_data(show_spinner=False)
+def cached_sort_index(gene_df):
+    """Sort index of the gene table, computed once per table"""
+    return build_sort_index(gene_df)
+
+@st.cache_data(show_spinner=False, max_entries=32)
+def cached_gene_mask(gene_df, min_r2, search):
+    """Rows passing the R2 threshold and gene search, computed once per query"""
+    return gene_table_mask(gene_df, min_r2=min_r2, search=search)
+
+def gene_table_view(gene_df):
+    """
+    Show a paginated, sortable and filterable gene table
+
+    Returns the gene of the selected row, or None.
+    """
+    sort_index = cached_sort_index(gene_df)
+    st.sidebar.header("Gene Table")
+    sort_by = st.sidebar.selectbox("Sort by", options=list(sort_index),
+                                   index=list(sort_index).index('Adj.Average'))
+    descending = st.sidebar.checkbox("Descending", value=True)
+    min_r2 = None
+    if st.sidebar.checkbox("Filter by R2", value=False):
+        min_r2 = st.sidebar.number_input("Min R2", value=0.0, step=0.05)
+    search = st.sidebar.text_input("Search Gene", value="").strip()
+    top_n = st.sidebar.number_input("Top N (0 = all)", value=0, min_value=0, step=100)
+    page_size = st.sidebar.selectbox("Rows per Page", options=[25, 50, 100, 200], index=1)
+    keep = cached_gene_mask(gene_df, min_r2, search)
+    n_matches = int(keep.sum()) if top_n == 0 else min(int(keep.sum()), int(top_n))
+    n_pages = max(int(np.ceil(n_matches / page_size)), 1)
+    # Clamp a page left over from a larger result to the last page
+    if st.session_state.get('gene_table_page', 1) > n_pages:
+        st.session_state['gene_table_page'] = n_pages
+    page = st.sidebar.number_input("Page", min_value=1, max_value=n_pages, step=1,
+                                   key='gene_table_page')
+
+    page_df, n_matches = query_gene_table(gene_df, sort_index, sort_by=sort_by,
+        ascending=not descending, top_n=int(top_n), page=int(page),
+        page_size=page_size, keep=keep)
+
+    st.caption(f"{n_matches:,} of {len(gene_df):,} genes, page {page} of {n_pages}. "
+               "Select a row to plot the gene.")
+    event = st.dataframe(page_df, use_container_width=True, hide_index=True,
+                         on_select='rerun', selection_mode='single-row')
+    if event.selection.rows:
+        return page_df['Gene'].iloc[event.selection.rows[0]]
+    return None
+
 def main():
     st.title("Analyze Adjusted Average Value for Individual Genes")
     st.markdown("""
@@ -120,36 +323,70 @@ def main():
         plot_params = plot_settings_sidebar()
     
     phasing_results = st.session_state.get('phasing_results', None)
+    # Data and gene tables are shared between sessions through the process-wide cache
+    cache = get_shared_cache()
+    session_id = get_session_id()
+
     # Add example data option
     use_example = st.checkbox("Use example data", value=False)
     
     if use_example:
-        df = load_example_data()
+        data_key = content_key('data/example_individual_gene.csv')
+        df = cache.get_or_compute(data_key, load_example_data, session_id)
         if df is not None:
             st.success("Using example data from data/example_individual_gene.csv")
     else:
         # File uploader
         uploaded_file = st.file_uploader(
-            "Choose a CSV file (required columns: Pos, Value)",
-            type="csv",
-            help="CSV should contain columns: Pos, Value"
+            "Choose a CSV, Parquet, Arrow or Feather file (required columns: Gene, Pos, Value)",
+            type=UPLOAD_TYPES,
+            help="File should contain columns: Gene, Pos, Value"
         )
         
         if uploaded_file is None:
-            st.info("Please upload a CSV file or use the example data.")
+            st.info("Please upload a file or use the example data.")
+            return
+        # Check header and a sample before parsing the whole file
+        report = validate_upload(uploaded_file, columns=('Gene', 'Pos', 'Value'),
+                                 location_range=plot_params['location_range'])
+        if not show_upload_report(report, allow_large=False):
             return
-        df = pd.read_csv(uploaded_file)
+        data_key = content_key(upload_key(uploaded_file), plot_params['location_range'])
+        df = cache.get_or_compute(data_key, lambda: read_phasing_table(
+            uploaded_file, columns=('Gene', 'Pos', 'Value'),
+            location_range=plot_params['location_range']), session_id)
     
     if df is not None:      
         xmin, xmax = plot_params['location_range']
-        gene_df = process_gene_data(
-            df, phasing_results, xmin=xmin, xmax=xmax)
-        # Show data preview
-        st.subheader("Result Preview")
-        st.dataframe(gene_df.head(), use_container_width=True)        
+        model, fit_params = population_model(phasing_results) if phasing_results else (None, None)
+        gene_key = content_key(data_key, model, fit_params, xmin, xmax)
+        gene_df = cache.get_or_compute(gene_key, lambda: process_gene_data(
+            df.copy(), phasing_results, xmin=xmin, xmax=xmax), session_id)
         st.session_state['gene_results'] = {
             'result_df': gene_df,
         }
+        st.sidebar.header("Profile Clustering")
+        use_clustering = st.sidebar.checkbox(
+            "Cluster genes by profile shape", value=False,
+            help="Group genes by their residual profile against the population fit "
+                 "(truncated SVD + mini-batch k-means)")
+        cluster_result = None
+        if use_clustering:
+            n_clusters = st.sidebar.number_input("Clusters", value=4, min_value=2, max_value=20)
+            bin_size = st.sidebar.number_input("Bin Size (bp)", value=10, min_value=1, max_value=100)
+            cluster_result = cache.get_or_compute(
+                content_key(gene_key, 'clusters', n_clusters, bin_size),
+                lambda: cluster_gene_profiles(
+                    df, phasing_results, xmin=xmin, xmax=xmax, n_clusters=int(n_clusters),
+                    bin_size=int(bin_size), seed=0), session_id)
+        if cluster_result is not None:
+            cluster_df, profile_df = cluster_result
+            gene_df = gene_df.merge(cluster_df[['Gene', 'Cluster']], on='Gene', how='left')
+            st.session_state['gene_results']['cluster_df'] = cluster_df
+            st.session_state['gene_results']['cluster_profile_df'] = profile_df
+        # Show the gene result table
+        st.subheader("Gene Results")
+        selected_gene = gene_table_view(gene_df)
         gene_dict = dict(zip(gene_df['Gene'], gene_df['Adj.Average']))
         st.download_button(
             label="Download Gene Table (CSV)",
@@ -157,9 +394,46 @@ def main():
                 file_name='gene_adjusted_average.csv',
                 mime='text/csv'
             )     
+        st.download_button(
+            label="Download Gene Table (Parquet)",
+            data=dataframe_to_parquet_bytes(gene_df),
+            file_name='gene_adjusted_average.parquet',
+            mime='application/octet-stream'
+        )
+        if cluster_result is not None:
+            st.subheader("Gene Profile Clusters")
+            st.pyplot(create_cluster_plot(profile_df, phasing_results, plot_params))
+            st.download_button(
+                label="Download Cluster Profiles (CSV)",
+                data=profile_df.to_csv(index=False).encode('utf-8'),
+                file_name='gene_cluster_profiles.csv',
+                mime='text/csv'
+            )
+        gene_heatmap_view(df, gene_df, phasing_results, gene_key, plot_params, cache, session_id)
+        st.sidebar.header("Spectral Spacing Estimation")
+        use_spectral = st.sidebar.checkbox(
+            "Estimate per-gene spacing (FFT)", value=False,
+            help="Fast batched spectral estimate of spacing and phasing strength for every gene")
+        if use_spectral:
+            spectral_df = cache.get_or_compute(
+                content_key(gene_key, 'spectral'),
+                lambda: estimate_gene_spacing_spectral(
+                    df, phasing_results, xmin=xmin, xmax=xmax), session_id)
+            if spectral_df is not None:
+                st.subheader("Spectral Spacing Estimation")
+                st.dataframe(spectral_df.head(), use_container_width=True)
+                st.session_state['gene_results']['spectral_df'] = spectral_df
+                st.download_button(
+                    label="Download Spectral Table (CSV)",
+                    data=spectral_df.to_csv(index=False).encode('utf-8'),
+                    file_name='gene_spectral_spacing.csv',
+                    mime='text/csv'
+                )
         st.sidebar.header("Figure of Individual Gene")
         target_gene = st.sidebar.text_input("Gene Name", value="")
         target_gene = target_gene.strip()
+        if len(target_gene) == 0 and selected_gene is not None:
+            target_gene = str(selected_gene)
         if len(target_gene) > 0:
             adj_value = gene_dict.get(target_gene, None)
             if adj_value is None:
@@ -0,0 +1,96 @@
+import hmac
+import os
+import streamlit as st
+from shared_cache import get_shared_cache, get_session_id
+from startup import import_time_report, check_startup_budget, setup_page
+
+setup_page("Cache Admin", "🗄️")
+
+def admin_token():
+    """
+    Token guarding this page, from the PHASING_ADMIN_TOKEN environment
+    variable or the 'admin_token' secret; None disables the page
+    """
+    token = os.environ.get('PHASING_ADMIN_TOKEN')
+    if token:
+        return token
+    try:
+        return st.secrets.get('admin_token') or None
+    except Exception:
+        return None
+
+def require_admin():
+    """
+    Stop the page unless this session entered the admin token
+    """
+    token = admin_token()
+    if token is None:
+        st.info("The cache admin page is disabled. Set PHASING_ADMIN_TOKEN or the "
+                "'admin_token' secret to enable it.")
+        st.stop()
+    if st.session_state.get('cache_admin_ok'):
+        return
+    entered = st.text_input("Admin Token", type="password")
+    if not entered:
+        st.stop()
+    if not hmac.compare_digest(entered.encode(), str(token).encode()):
+        st.error("Invalid admin token")
+        st.stop()
+    st.session_state['cache_admin_ok'] = True
+
+def display_cache_stats(cache):
+    """
+    Display occupancy of the shared cache
+    """
+    stats = cache.stats()
+    col1, col2, col3, col4 = st.columns(4)
+    with col1:
+        st.metric("Cached Entries", f"{stats['entries']}")
+        st.metric("Active Sessions", f"{stats['sessions']}")
+    with col2:
+        st.metric("Memory Used (MB)", f"{stats['total_bytes'] / 2**20:.1f}")
+        st.metric("Memory Ceiling (MB)", f"{stats['max_bytes'] / 2**20:.0f}")
+    with col3:
+        st.metric("Hits", f"{stats['hits']}")
+        st.metric("Misses", f"{stats['misses']}")
+    with col4:
+        st.metric("Evictions", f"{stats['evictions']}")
+        st.metric("This Session (MB)",
+                  f"{cache.session_usage(get_session_id()) / 2**20:.1f}")
+    st.progress(min(stats['total_bytes'] / stats['max_bytes'], 1.0))
+
+def main():
+    st.title("Shared Cache")
+    st.markdown("""
+    Data and fitting results are shared between all sessions of this server.
+    This page shows how much memory the shared cache holds and which sessions reference it.
+    """)
+    require_admin()
+    cache = get_shared_cache()
+    display_cache_stats(cache)
+
+    st.subheader("Entries")
+    st.dataframe(cache.entries_table(), use_container_width=True, hide_index=True)
+
+    st.subheader("Sessions")
+    st.dataframe(cache.sessions_table(), use_container_width=True, hide_index=True)
+
+    if st.button("Clear Cache"):
+        cache.clear()
+        st.rerun()
+
+    st.subheader("Startup Profile")
+    st.markdown("Cold import time of the app modules, measured in a fresh interpreter.")
+    if st.button("Profile Imports"):
+        summary_df, slowest_df = import_time_report()
+        budget_df = check_startup_budget(summary_df=summary_df)
+        if budget_df['Within Budget'].all():
+            st.success("All modules are within the startup budget")
+        else:
+            st.error("Some modules exceed the startup budget")
+        st.dataframe(budget_df, use_container_width=True, hide_index=True)
+        st.dataframe(slowest_df, use_container_width=True, hide_index=True)
+
+
+if __name__ == "__main__":
+    main()
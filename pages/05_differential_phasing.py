@@ -0,0 +1,165 @@
+import streamlit as st
+import numpy as np
+from lazy_imports import lazy_import
+from utility import (
+    process_data, aggregate_profile, process_differential_gene_data,
+    get_plot_defaults, read_phasing_table, validate_upload, show_upload_report,
+    dataframe_to_parquet_bytes, UPLOAD_TYPES
+)
+from shared_cache import get_shared_cache, get_session_id, content_key, upload_key
+from startup import setup_page
+
+pd = lazy_import('pandas')
+sns = lazy_import('seaborn')
+plt = lazy_import('matplotlib.pyplot')
+
+setup_page("Differential Phasing", "⚖️")
+
+def settings_sidebar():
+    """
+    Create sidebar for analysis settings
+    """
+    st.sidebar.header("Analysis Settings")
+    defaults = get_plot_defaults()
+    col1, col2 = st.sidebar.columns(2)
+    with col1:
+        pos_min = st.number_input("Pos Min", value=defaults['location_range'][0])
+        label_a = st.text_input("Condition A", value="WT")
+    with col2:
+        pos_max = st.number_input("Pos Max", value=defaults['location_range'][1])
+        label_b = st.text_input("Condition B", value="Mutant")
+    n_boot = st.sidebar.number_input("Bootstrap Resamples", value=200, min_value=50, step=50)
+    top_n = st.sidebar.number_input("Genes Shown", value=100, min_value=10, step=50)
+    return {
+        'location_range': [pos_min, pos_max],
+        'labels': (label_a.strip() or 'A', label_b.strip() or 'B'),
+        'n_boot': int(n_boot),
+        'top_n': int(top_n),
+    }
+
+def load_condition(label, key, location_range, cache, session_id):
+    """
+    Upload, validate and read the gene table of one condition
+
+    Returns (data_key, dataframe) or (None, None).
+    """
+    uploaded_file = st.file_uploader(
+        f"{label} gene table (required columns: Gene, Pos, Value)",
+        type=UPLOAD_TYPES,
+        key=key
+    )
+    if uploaded_file is None:
+        return None, None
+    report = validate_upload(uploaded_file, columns=('Gene', 'Pos', 'Value'),
+                             location_range=location_range)
+    if not show_upload_report(report, show_size=False, allow_large=False):
+        return None, None
+    data_key = content_key(upload_key(uploaded_file), location_range)
+    df = cache.get_or_compute(data_key, lambda: read_phasing_table(
+        uploaded_file, columns=('Gene', 'Pos', 'Value'),
+        location_range=location_range), session_id)
+    return data_key, df
+
+def fit_population(df, xmin, xmax):
+    """
+    Fit the population profile of one condition, warm-started from the
+    fit of its per-position means
+    """
+    agg_df = aggregate_profile(df, xmin=xmin, xmax=xmax)
+    prelim = process_data(agg_df, xmin=xmin, xmax=xmax)
+    if prelim is None or prelim[1] is None:
+        return None
+    processed = process_data(df[['Pos', 'Value']].copy(), xmin=xmin, xmax=xmax,
+                             start_result=prelim[1])
+    if processed is None or processed[1] is None:
+        return None
+    return {'results': processed[1]}
+
+def create_volcano_plot(diff_df):
+    """
+    Create volcano plot of the adjusted average change
+    """
+    fig, ax = plt.subplots(figsize=(5, 4))
+    log_p = -np.log10(np.clip(diff_df['P_value'].values, 1e-300, 1))
+    significant = diff_df['Q_value'].values < 0.05
+    sns.scatterplot(x=diff_df['Delta.Adj.Average'], y=log_p, hue=significant, s=5,
+                    palette={True: 'red', False: '.5'}, linewidth=0, ax=ax)
+    ax.set(xlabel='Delta Adjusted Average', ylabel='-log10(P value)',
+           title='Differential Phasing')
+    ax.legend(title='Q < 0.05', markerscale=2)
+    return fig
+
+def main():
+    st.title("Differential Phasing Between Two Conditions")
+    st.markdown("""
+    Compare the adjusted average value of every gene between two conditions.
+    Each condition is adjusted against its own population fit, and genes are ranked by the significance of the change.
+    """)
+    settings = settings_sidebar()
+    label_a, label_b = settings['labels']
+    if label_a == label_b:
+        st.error("The two conditions need different labels.")
+        return
+    xmin, xmax = settings['location_range']
+    cache = get_shared_cache()
+    session_id = get_session_id()
+
+    col1, col2 = st.columns(2)
+    with col1:
+        key_a, df_a = load_condition(label_a, 'upload_a', settings['location_range'],
+                                     cache, session_id)
+    with col2:
+        key_b, df_b = load_condition(label_b, 'upload_b', settings['location_range'],
+                                     cache, session_id)
+    if df_a is None or df_b is None:
+        st.info("Please upload the gene tables of both conditions.")
+        return
+
+    fit_a = cache.get_or_compute(content_key(key_a, xmin, xmax, 'population'),
+                                 lambda: fit_population(df_a, xmin, xmax), session_id)
+    fit_b = cache.get_or_compute(content_key(key_b, xmin, xmax, 'population'),
+                                 lambda: fit_population(df_b, xmin, xmax), session_id)
+    if fit_a is None or fit_b is None:
+        return
+
+    st.subheader("Population Fits")
+    fit_df = pd.DataFrame({
+        label: {'Spacing': fit['results']['Spacing'], 'Amplitude': fit['results']['Amplitude'],
+                'Decay': fit['results']['Decay'], 'Adj.R2': fit['results']['Adj.R2']}
+        for label, fit in ((label_a, fit_a), (label_b, fit_b))})
+    st.dataframe(fit_df, use_container_width=True)
+
+    diff_df = cache.get_or_compute(
+        content_key(key_a, key_b, xmin, xmax, settings['labels'], settings['n_boot']),
+        lambda: process_differential_gene_data(
+            df_a, fit_a, df_b, fit_b, labels=settings['labels'],
+            xmin=xmin, xmax=xmax, n_boot=settings['n_boot'], seed=0),
+        session_id)
+    if diff_df is None:
+        return
+
+    st.subheader("Differential Gene Table")
+    st.caption(f"{len(diff_df):,} genes in both tables, "
+               f"{int((diff_df['Q_value'] < 0.05).sum()):,} with Q < 0.05")
+    st.dataframe(diff_df.head(settings['top_n']), use_container_width=True, hide_index=True)
+    st.pyplot(create_volcano_plot(diff_df))
+
+    col1, col2 = st.columns(2)
+    with col1:
+        st.download_button(
+            label="Download Differential Table (CSV)",
+            data=diff_df.to_csv(index=False).encode('utf-8'),
+            file_name='differential_phasing.csv',
+            mime='text/csv'
+        )
+    with col2:
+        st.download_button(
+            label="Download Differential Table (Parquet)",
+            data=dataframe_to_parquet_bytes(diff_df),
+            file_name='differential_phasing.parquet',
+            mime='application/octet-stream'
+        )
+
+
+if __name__ == "__main__":
+    main()
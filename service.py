@@ -0,0 +1,264 @@
+import argparse
+import io
+import json
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+from lazy_imports import lazy_import
+
+pd = lazy_import('pandas')
+
+
+def _preload():
+    """
+    Worker initializer: import the fitting stack once per worker process
+    """
+    import pandas  # noqa: F401
+    import scipy.optimize  # noqa: F401
+    import utility  # noqa: F401
+
+
+def fit_profile(pos, value, xmin=-50, xmax=1000, options=None):
+    """
+    Fit one Pos/Value profile as the analysis page does
+
+    Returns:
+    --------
+    dict
+        JSON-safe fitting result (as from prepare_results_for_json), or a
+        dict with an 'error' key holding the cause
+    """
+    from utility import fit_phasing_profile, prepare_results_for_json
+    try:
+        pos = np.asarray(pos).astype(int)
+        value = np.asarray(value, dtype=float)
+        keep = (pos >= xmin) & (pos <= xmax)
+        order = np.argsort(pos[keep], kind='stable')
+        result = fit_phasing_profile(value[keep][order], pos[keep][order], **(options or {}))
+    except Exception as e:
+        return {'error': f'Fitting failed: {str(e)}'}
+    return prepare_results_for_json(result)
+
+
+def fit_gene_table(gene, pos, value, fit_params, xmin=-50, xmax=1000):
+    """
+    Compute the adjusted average of every gene against population fit_params
+
+    Returns:
+    --------
+    dict
+        {'genes': [records with Gene, Adj.Average, R2]} or {'error': ...}
+    """
+    from utility import process_gene_data
+    if np.shape(fit_params) != (6,):
+        return {'error': 'fit_params must hold the 6 parameters [A, l, w_0, theta_0, b, s]'}
+    df = pd.DataFrame({'Gene': gene, 'Pos': pos, 'Value': value})
+    gene_df = process_gene_data(df, {'results': {'fit_params': np.asarray(fit_params)}},
+                                xmin=xmin, xmax=xmax)
+    if gene_df is None:
+        return {'error': 'Gene processing failed'}
+    return {'genes': json.loads(gene_df.to_json(orient='records'))}
+
+
+class FittingService:
+    """
+    Persistent worker pool with request latency and queue depth metrics
+    """
+
+    def __init__(self, workers: int=None, latency_window: int=1000):
+        self.workers = workers or os.cpu_count() or 1
+        self.executor = ProcessPoolExecutor(max_workers=self.workers, initializer=_preload)
+        self._lock = threading.Lock()
+        self._latencies = deque(maxlen=latency_window)
+        self.pending = 0
+        self.requests = 0
+        self.profiles = 0
+        self.errors = 0
+
+    def submit_many(self, fn, calls):
+        """
+        Run fn(*args, **kwargs) for every (args, kwargs) in calls on the pool
+        """
+        with self._lock:
+            self.pending += len(calls)
+        futures = [self.executor.submit(fn, *args, **kwargs) for args, kwargs in calls]
+        results = []
+        for future in futures:
+            try:
+                results.append(future.result())
+            except Exception as e:
+                results.append({'error': str(e)})
+            finally:
+                with self._lock:
+                    self.pending -= 1
+        return results
+
+    def record(self, latency, n_profiles, failed):
+        with self._lock:
+            self._latencies.append(latency)
+            self.requests += 1
+            self.profiles += n_profiles
+            self.errors += int(failed)
+
+    def metrics(self):
+        with self._lock:
+            latencies = np.array(self._latencies) * 1000
+            pending = self.pending
+            counts = (self.requests, self.profiles, self.errors)
+        summary = {'requests': counts[0], 'profiles': counts[1], 'errors': counts[2],
+                   'queue_depth': pending, 'workers': self.workers}
+        if len(latencies) > 0:
+            summary.update({
+                'latency_ms_mean': float(latencies.mean()),
+                'latency_ms_p50': float(np.percentile(latencies, 50)),
+                'latency_ms_p95': float(np.percentile(latencies, 95)),
+                'latency_ms_max': float(latencies.max()),
+            })
+        return summary
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+
+
+def _read_payload(handler):
+    """
+    Decode a JSON body or a binary .npz body into a dict of arrays/values
+    """
+    length = int(handler.headers.get('Content-Length', 0))
+    body = handler.rfile.read(length)
+    content_type = handler.headers.get('Content-Type', 'application/json')
+    if content_type.startswith('application/json'):
+        return json.loads(body or b'{}')
+    with np.load(io.BytesIO(body), allow_pickle=False) as npz:
+        payload = {key: npz[key] for key in npz.files}
+    # Fit options travel as a JSON string
+    if 'options' in payload:
+        payload['options'] = json.loads(str(payload['options']))
+    return payload
+
+
+def _split_profiles(payload):
+    """
+    Turn a payload into a list of (pos, value, xmin, xmax) profiles
+
+    Accepted layouts: {'pos', 'value'} for one profile, {'profiles': [...]}
+    of such dicts, or flat 'pos'/'value' arrays with a 'profile' id array
+    marking which profile each row belongs to.
+    """
+    xmin = int(payload.get('xmin', -50))
+    xmax = int(payload.get('xmax', 1000))
+    if 'profiles' in payload:
+        return [(p['pos'], p['value'], int(p.get('xmin', xmin)), int(p.get('xmax', xmax)))
+                for p in payload['profiles']]
+    pos = np.asarray(payload['pos'])
+    value = np.asarray(payload['value'])
+    if 'profile' not in payload:
+        return [(pos, value, xmin, xmax)]
+    ids = np.asarray(payload['profile'])
+    order = np.argsort(ids, kind='stable')
+    bounds = np.flatnonzero(np.diff(ids[order])) + 1
+    return [(pos[rows], value[rows], xmin, xmax) for rows in np.split(order, bounds)]
+
+
+def make_handler(service):
+    """
+    Build the request handler class bound to a FittingService
+    """
+
+    class FittingHandler(BaseHTTPRequestHandler):
+
+        def _send_json(self, status, data):
+            from utility import prepare_results_for_json
+            # Strict JSON: NaN and inf are sent as null
+            body = json.dumps(prepare_results_for_json(data), allow_nan=False).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == '/health':
+                self._send_json(200, {'status': 'ok'})
+            elif self.path == '/metrics':
+                self._send_json(200, service.metrics())
+            else:
+                self._send_json(404, {'error': f'Unknown path: {self.path}'})
+
+        def do_POST(self):
+            start = time.perf_counter()
+            try:
+                payload = _read_payload(self)
+                if self.path == '/fit':
+                    profiles = _split_profiles(payload)
+                    options = payload.get('options')
+                    results = service.submit_many(fit_profile, [
+                        ((pos, value, xmin, xmax), {'options': options})
+                        for pos, value, xmin, xmax in profiles])
+                    response = {'results': results}
+                    n_profiles = len(profiles)
+                elif self.path == '/genes':
+                    results = service.submit_many(fit_gene_table, [(
+                        (payload['gene'], payload['pos'], payload['value'],
+                         payload['fit_params']),
+                        {'xmin': int(payload.get('xmin', -50)),
+                         'xmax': int(payload.get('xmax', 1000))})])
+                    response = results[0]
+                    n_profiles = 1
+                else:
+                    self._send_json(404, {'error': f'Unknown path: {self.path}'})
+                    return
+            except (KeyError, ValueError, TypeError, AttributeError, IndexError) as e:
+                service.record(time.perf_counter() - start, 0, True)
+                self._send_json(400, {'error': f'Invalid request: {type(e).__name__}: {str(e)}'})
+                return
+            except Exception as e:
+                service.record(time.perf_counter() - start, 0, True)
+                self._send_json(500, {'error': f'Internal error: {type(e).__name__}: {str(e)}'})
+                return
+            failed = any('error' in r for r in response.get('results', [response]))
+            service.record(time.perf_counter() - start, n_profiles, failed)
+            self._send_json(200, response)
+
+        def log_message(self, format, *args):
+            pass
+
+    return FittingHandler
+
+
+def serve(host: str='127.0.0.1', port: int=8765, workers: int=None):
+    """
+    Run the fitting service until interrupted
+    """
+    service = FittingService(workers=workers)
+    # Start the workers now so the first request does not pay for imports
+    service.submit_many(_preload, [((), {})] * service.workers)
+    server = ThreadingHTTPServer((host, port), make_handler(service))
+    print(f"Fitting service on http://{host}:{port} with {service.workers} workers")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.shutdown()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Local HTTP service for phasing fits and gene adjusted averages")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--workers', type=int, default=None,
+                        help="Worker processes (default: number of CPUs)")
+    args = parser.parse_args()
+    serve(host=args.host, port=args.port, workers=args.workers)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,309 @@
+import hashlib
+import sys
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+import numpy as np
+import streamlit as st
+from lazy_imports import lazy_import
+
+pd = lazy_import('pandas')
+
+
+def content_key(*parts):
+    """
+    Build a cache key from the content of the given parts
+
+    Parameters:
+    -----------
+    parts : bytes, str, numpy.ndarray, pandas.DataFrame or any repr-able value
+        Values hashed, in order, into the key
+
+    Returns:
+    --------
+    str
+        Hex digest identifying the content
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    for part in parts:
+        if isinstance(part, (bytes, bytearray, memoryview)):
+            digest.update(part)
+        elif isinstance(part, np.ndarray):
+            digest.update(np.ascontiguousarray(part).tobytes())
+        elif isinstance(part, pd.DataFrame):
+            digest.update(repr(list(part.columns)).encode())
+            digest.update(pd.util.hash_pandas_object(part, index=False).values.tobytes())
+        else:
+            digest.update(repr(part).encode())
+        digest.update(b'|')
+    return digest.hexdigest()
+
+
+def estimate_nbytes(value):
+    """
+    Estimate the memory held by a cached value
+    """
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(index=True, deep=True).sum())
+    if isinstance(value, np.ndarray):
+        return int(value.nbytes)
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(estimate_nbytes(v) for v in value.values())
+    if isinstance(value, (list, tuple)):
+        return sys.getsizeof(value) + sum(estimate_nbytes(v) for v in value)
+    return sys.getsizeof(value)
+
+
+def _freeze_frame(df):
+    """
+    Copy a DataFrame onto read-only column arrays
+
+    Extension-dtype columns (e.g. strings) are kept as they are.
+    """
+    columns = {}
+    for col in df.columns:
+        if isinstance(df[col].dtype, np.dtype):
+            values = df[col].to_numpy(copy=True)
+            values.setflags(write=False)
+        else:
+            values = df[col].array
+        columns[col] = values
+    return pd.DataFrame(columns, index=df.index, copy=False)
+
+
+def _freeze(value):
+    """
+    Make the arrays and frames inside a cached value read-only
+
+    DataFrames are replaced by copies on read-only arrays, so in-place
+    writes such as df.loc[...] = ... raise instead of changing the shared
+    value. Returns the frozen value.
+    """
+    if isinstance(value, np.ndarray):
+        value.setflags(write=False)
+    elif isinstance(value, pd.DataFrame):
+        return _freeze_frame(value)
+    elif isinstance(value, dict):
+        for k, v in value.items():
+            value[k] = _freeze(v)
+    elif isinstance(value, list):
+        value[:] = [_freeze(v) for v in value]
+    elif isinstance(value, tuple):
+        return tuple(_freeze(v) for v in value)
+    return value
+
+
+class SharedCache:
+    """
+    Process-wide LRU cache of immutable frames, arrays and fit results
+
+    Entries are keyed by content hash and shared by every session that
+    references them. Each session's referenced bytes are capped by a
+    quota (its least recently used references are dropped first) and the
+    total size is capped by a global ceiling (least recently used entries
+    are evicted, preferring entries no session references).
+
+    Cached values are shared, so callers must not mutate them: arrays and
+    DataFrame columns are made read-only on put, and dicts, lists and
+    DataFrame structure (columns, index) must be copied before changes.
+    """
+
+    def __init__(self, max_bytes: int=2 << 30, session_quota_bytes: int=512 << 20,
+            session_ttl: float=3600):
+        self.max_bytes = max_bytes
+        self.session_quota_bytes = session_quota_bytes
+        self.session_ttl = session_ttl
+        self._entries = OrderedDict()
+        self._sessions = {}
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, session_id=None):
+        """
+        Return the cached value for key (or None) and record the reference
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(key)
+            entry['last_used'] = time.time()
+            if session_id is not None:
+                self._reference(session_id, key)
+            return entry['value']
+
+    def put(self, key, value, session_id=None):
+        """
+        Store value under key and return the shared instance
+
+        If the key is already cached the existing instance is returned, so
+        the caller can drop its own copy.
+        """
+        with self._lock:
+            if key in self._entries:
+                return self.get(key, session_id)
+        value = _freeze(value)
+        with self._lock:
+            if key in self._entries:
+                return self.get(key, session_id)
+            now = time.time()
+            self._entries[key] = {
+                'value': value,
+                'nbytes': estimate_nbytes(value),
+                'sessions': set(),
+                'created': now,
+                'last_used': now,
+            }
+            if session_id is not None:
+                self._reference(session_id, key)
+            self._expire_sessions()
+            self._evict()
+            return value
+
+    def get_or_compute(self, key, compute, session_id=None):
+        """
+        Return the cached value for key, computing and storing it on a miss
+
+        None results of compute are returned but not cached.
+        """
+        value = self.get(key, session_id)
+        if value is not None:
+            return value
+        value = compute()
+        if value is None:
+            return None
+        return self.put(key, value, session_id)
+
+    def release_session(self, session_id):
+        """
+        Drop every reference held by a session
+        """
+        with self._lock:
+            for key in self._sessions.pop(session_id, {}).get('keys', ()):
+                if key in self._entries:
+                    self._entries[key]['sessions'].discard(session_id)
+
+    def clear(self):
+        """
+        Remove all entries and session accounting
+        """
+        with self._lock:
+            self._entries.clear()
+            self._sessions.clear()
+
+    def session_usage(self, session_id):
+        """
+        Bytes of cached entries referenced by a session
+        """
+        with self._lock:
+            keys = self._sessions.get(session_id, {}).get('keys', ())
+            return sum(self._entries[k]['nbytes'] for k in keys if k in self._entries)
+
+    def stats(self):
+        """
+        Summary of cache occupancy
+        """
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'total_bytes': sum(e['nbytes'] for e in self._entries.values()),
+                'max_bytes': self.max_bytes,
+                'sessions': len(self._sessions),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+    def entries_table(self):
+        """
+        One row per cached entry, most recently used first
+        """
+        with self._lock:
+            rows = [(key, type(e['value']).__name__, e['nbytes'] / 2**20,
+                     len(e['sessions']), e['created'], e['last_used'])
+                    for key, e in reversed(self._entries.items())]
+        table = pd.DataFrame(rows, columns=['Key', 'Type', 'Size (MB)', 'Sessions',
+                                            'Created', 'Last Used'])
+        for col in ('Created', 'Last Used'):
+            table[col] = pd.to_datetime(table[col], unit='s')
+        return table
+
+    def sessions_table(self):
+        """
+        One row per session with its referenced bytes and quota
+        """
+        with self._lock:
+            rows = [(sid, len(s['keys']), self.session_usage(sid) / 2**20,
+                     self.session_quota_bytes / 2**20, s['last_seen'])
+                    for sid, s in self._sessions.items()]
+        table = pd.DataFrame(rows, columns=['Session', 'Entries', 'Usage (MB)',
+                                            'Quota (MB)', 'Last Seen'])
+        table['Last Seen'] = pd.to_datetime(table['Last Seen'], unit='s')
+        return table
+
+    def _reference(self, session_id, key):
+        session = self._sessions.setdefault(session_id, {'keys': OrderedDict(),
+                                                         'last_seen': 0})
+        session['keys'][key] = True
+        session['keys'].move_to_end(key)
+        session['last_seen'] = time.time()
+        self._entries[key]['sessions'].add(session_id)
+        # Enforce the session quota, keeping the newest reference
+        while len(session['keys']) > 1 and \
+                self.session_usage(session_id) > self.session_quota_bytes:
+            old_key, _ = session['keys'].popitem(last=False)
+            if old_key in self._entries:
+                self._entries[old_key]['sessions'].discard(session_id)
+
+    def _expire_sessions(self):
+        cutoff = time.time() - self.session_ttl
+        for session_id in [sid for sid, s in self._sessions.items()
+                           if s['last_seen'] < cutoff]:
+            self.release_session(session_id)
+
+    def _evict(self):
+        total = sum(e['nbytes'] for e in self._entries.values())
+        # Unreferenced entries go first, each group in LRU order
+        candidates = ([k for k, e in self._entries.items() if not e['sessions']]
+                      + [k for k, e in self._entries.items() if e['sessions']])
+        for key in candidates:
+            if total <= self.max_bytes or len(self._entries) <= 1:
+                break
+            entry = self._entries.pop(key)
+            total -= entry['nbytes']
+            self.evictions += 1
+            for session_id in entry['sessions']:
+                self._sessions.get(session_id, {}).get('keys', {}).pop(key, None)
+
+
+@st.cache_resource
+def get_shared_cache():
+    """
+    Return the process-wide SharedCache
+    """
+    return SharedCache()
+
+
+def get_session_id():
+    """
+    Return a stable identifier for the current browser session
+    """
+    if 'cache_session_id' not in st.session_state:
+        st.session_state['cache_session_id'] = uuid.uuid4().hex
+    return st.session_state['cache_session_id']
+
+
+def upload_key(uploaded_file):
+    """
+    Return the content key of an uploaded file, hashing it once per upload
+    """
+    keys = st.session_state.setdefault('upload_keys', {})
+    if uploaded_file.file_id not in keys:
+        keys[uploaded_file.file_id] = content_key(uploaded_file.getvalue())
+    return keys[uploaded_file.file_id]
@@ -0,0 +1,192 @@
+import argparse
+import os
+import subprocess
+import sys
+import threading
+
+import streamlit as st
+from lazy_imports import import_module, lazy_import
+from shared_cache import content_key, get_shared_cache
+from utility import get_plot_defaults, process_data, read_phasing_table
+
+pd = lazy_import('pandas')
+
+EXAMPLE_PHASING = 'data/example_phasing.parquet'
+
+# Fit options used by the analysis page before any sidebar change
+DEFAULT_FIT_OPTIONS = {'models': None, 'criterion': 'BIC', 'multistart': False}
+
+# Modules loaded lazily by the pages, preloaded in the background at startup
+HEAVY_MODULES = ['pandas', 'scipy.optimize', 'pyarrow.parquet',
+                 'matplotlib.pyplot', 'seaborn']
+
+# Cold import budgets (ms) checked by check_startup_budget
+STARTUP_BUDGET_MS = {
+    'utility': 300,
+    'shared_cache': 800,
+    'startup': 800,
+}
+
+
+def example_data_key(location_range):
+    """
+    Cache key of the example data read for a location range
+    """
+    return content_key(EXAMPLE_PHASING, list(location_range))
+
+
+def fit_cache_key(data_key, xmin, xmax, fit_options):
+    """
+    Cache key of a phasing fit of cached data
+    """
+    return content_key(data_key, xmin, xmax, fit_options)
+
+
+def preload_modules(modules=HEAVY_MODULES):
+    """
+    Import the heavy modules so the first page visit finds them loaded
+    """
+    for name in modules:
+        # Under the shared import lock, so page scripts never see a half-imported module
+        import_module(name)
+
+
+def warm_example_cache(cache, location_range=None):
+    """
+    Load the example data and fit it into the shared cache with the keys
+    used by the analysis page for its default settings
+    """
+    if location_range is None:
+        location_range = get_plot_defaults()['location_range']
+    xmin, xmax = location_range
+    data_key = example_data_key(location_range)
+    df = cache.get_or_compute(data_key, lambda: read_phasing_table(
+        EXAMPLE_PHASING, columns=('Pos', 'Value'), location_range=location_range))
+    if df is None:
+        return
+    fit_key = fit_cache_key(data_key, xmin, xmax, DEFAULT_FIT_OPTIONS)
+    if cache.get(fit_key) is None:
+        processed_result = process_data(df.copy(), xmin=xmin, xmax=xmax,
+                                        **DEFAULT_FIT_OPTIONS)
+        if processed_result is not None and processed_result[1] is not None:
+            cache.put(fit_key, processed_result)
+
+
+def _warm_up():
+    preload_modules()
+    warm_example_cache(get_shared_cache())
+
+
+@st.cache_resource
+def start_warm_up():
+    """
+    Start the background warm-up once per server process
+    """
+    thread = threading.Thread(target=_warm_up, name='warm-up', daemon=True)
+    thread.start()
+    return thread
+
+
+def setup_page(page_title=None, page_icon=None):
+    """
+    Set up a page and start the background warm-up
+
+    Every page calls this first, so the warm-up starts whichever page a
+    visit opens. The page config is only set when page_title is given.
+    """
+    if page_title is not None:
+        st.set_page_config(page_title=page_title, page_icon=page_icon, layout="wide")
+    start_warm_up()
+
+
+def profile_imports(module, cwd=None):
+    """
+    Measure a cold import of a module with python -X importtime
+
+    Parameters:
+    -----------
+    module : str
+        Module imported in a fresh interpreter
+    cwd : str
+        Working directory (default: this repository)
+
+    Returns:
+    --------
+    pandas.DataFrame
+        One row per imported module with columns: 'Module', 'Depth',
+        'Self (ms)', 'Cumulative (ms)'
+    """
+    if cwd is None:
+        cwd = os.path.dirname(os.path.abspath(__file__))
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                          cwd=cwd, capture_output=True, text=True, check=True)
+    rows = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cum_us, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip())) // 2
+        rows.append((name.strip(), depth, int(self_us) / 1000, int(cum_us) / 1000))
+    return pd.DataFrame(rows, columns=['Module', 'Depth', 'Self (ms)', 'Cumulative (ms)'])
+
+
+def import_time_report(modules=tuple(STARTUP_BUDGET_MS), top=10):
+    """
+    Cold import time of each module and its slowest dependencies
+
+    Returns:
+    --------
+    tuple
+        (summary_dataframe, top_dependencies_dataframe)
+    """
+    summary, slowest = [], []
+    for module in modules:
+        profile = profile_imports(module)
+        total = profile.loc[profile['Depth'] == 0, 'Cumulative (ms)'].sum()
+        summary.append((module, total))
+        deps = profile.loc[profile['Depth'] == 1].nlargest(top, 'Cumulative (ms)')
+        slowest.append(deps.assign(Target=module))
+    summary_df = pd.DataFrame(summary, columns=['Module', 'Import Time (ms)'])
+    slowest_df = pd.concat(slowest, ignore_index=True)[
+        ['Target', 'Module', 'Self (ms)', 'Cumulative (ms)']]
+    return summary_df, slowest_df
+
+
+def check_startup_budget(budgets=STARTUP_BUDGET_MS, summary_df=None):
+    """
+    Compare cold import times against their budgets
+
+    summary_df may hold an earlier import_time_report summary of the same
+    modules to avoid profiling them twice.
+
+    Returns:
+    --------
+    pandas.DataFrame
+        Columns: 'Module', 'Import Time (ms)', 'Budget (ms)', 'Within Budget'
+    """
+    if summary_df is None:
+        summary_df, _ = import_time_report(tuple(budgets))
+    summary_df = summary_df.copy()
+    summary_df['Budget (ms)'] = summary_df['Module'].map(budgets)
+    summary_df['Within Budget'] = summary_df['Import Time (ms)'] <= summary_df['Budget (ms)']
+    return summary_df
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Report cold import times and check them against the startup budget")
+    parser.add_argument('--top', type=int, default=10,
+                        help="Number of slowest dependencies listed per module")
+    args = parser.parse_args()
+
+    summary_df, slowest_df = import_time_report(top=args.top)
+    budget_df = check_startup_budget(summary_df=summary_df)
+    print(slowest_df.to_string(index=False))
+    print()
+    print(budget_df.to_string(index=False))
+    if not budget_df['Within Budget'].all():
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,7 @@
 import streamlit as st
+from startup import setup_page
 
-st.set_page_config(
-    page_title="Sine Wave Phasing Analysis Home",
-    page_icon="🏠",
-    layout="wide"
-)
+setup_page("Sine Wave Phasing Analysis Home", "🏠")
 
 
 
@@ -81,7 +78,7 @@ with col1:
         <h3>Data Analysis</h3>
         <p>Upload and analyze your phasing data:</p>
         <ul>
-            <li>Upload CSV data files</li>
+            <li>Upload CSV, Parquet, Arrow or Feather data files</li>
             <li>Fit the data with decaying sine wave model</li>
             <li>Visualize results with interactive plots</li>
             <li>Download processed data and figures</li>
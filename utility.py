@@ -1,8 +1,23 @@
-import pandas as pd
-import pandas as pd
+from __future__ import annotations
+
+import io
+import os
+import time
 import numpy as np
-from scipy.optimize import curve_fit
-import streamlit as st
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from lazy_imports import lazy_import
+
+# Heavy stacks are loaded on first use
+pd = lazy_import('pandas')
+st = lazy_import('streamlit')
+optimize = lazy_import('scipy.optimize')
+special = lazy_import('scipy.special')
+pa = lazy_import('pyarrow')
+pc = lazy_import('pyarrow.compute')
+pv = lazy_import('pyarrow.csv')
+feather = lazy_import('pyarrow.feather')
+ipc = lazy_import('pyarrow.ipc')
+pq = lazy_import('pyarrow.parquet')
 
 def fit_function(x, A, l, w_0, theta_0, b, s):
     """
@@ -39,7 +54,322 @@ def lower_function(x, A, l, b, s):
     """
     return -A * np.exp(-l * x) + b + s*x
 
-def calc_sine_fit(y, xpos):
+def fit_function_no_slope(x, A, l, w_0, theta_0, b):
+    """
+    Define the decaying sine wave fitting function without slope
+    """
+    return fit_function(x, A, l, w_0, theta_0, b, 0)
+
+
+def fit_function_no_decay(x, A, w_0, theta_0, b, s):
+    """
+    Define the sine wave fitting function without exponential decay
+    """
+    return fit_function(x, A, 0, w_0, theta_0, b, s)
+
+
+def fit_function_two_freq(x, A, l, w_0, theta_0, b, s, A_2, w_2, theta_2):
+    """
+    Define the decaying sine wave fitting function with a second frequency
+    component sharing the decay constant
+    """
+    return (fit_function(x, A, l, w_0, theta_0, b, s)
+            + A_2 * np.exp(-l * x) * np.sin(w_2 * x + theta_2))
+
+
+def _damped_sine_terms(x, A, l, w_0, theta_0):
+    """
+    Value of A * exp(-l * x) * sin(w_0 * x + theta_0) and its partial
+    derivatives by (A, l, w_0, theta_0), from one exp, sin and cos
+    """
+    envelope = np.exp(-l * x)
+    phase = w_0 * x + theta_0
+    es = envelope * np.sin(phase)
+    ec = A * envelope * np.cos(phase)
+    return A * es, np.column_stack([es, -x * A * es, x * ec, ec])
+
+
+def _jacobian_full(x, A, l, w_0, theta_0, b, s):
+    _, d = _damped_sine_terms(x, A, l, w_0, theta_0)
+    return np.column_stack([d, np.ones_like(x), x])
+
+
+def _jacobian_no_slope(x, A, l, w_0, theta_0, b):
+    _, d = _damped_sine_terms(x, A, l, w_0, theta_0)
+    return np.column_stack([d, np.ones_like(x)])
+
+
+def _jacobian_no_decay(x, A, w_0, theta_0, b, s):
+    _, d = _damped_sine_terms(x, A, 0, w_0, theta_0)
+    return np.column_stack([d[:, [0, 2, 3]], np.ones_like(x), x])
+
+
+def _jacobian_two_freq(x, A, l, w_0, theta_0, b, s, A_2, w_2, theta_2):
+    _, d = _damped_sine_terms(x, A, l, w_0, theta_0)
+    _, d_2 = _damped_sine_terms(x, A_2, l, w_2, theta_2)
+    d[:, 1] += d_2[:, 1]
+    return np.column_stack([d, np.ones_like(x), x, d_2[:, [0, 2, 3]]])
+
+
+# Registry of candidate models. 'guess' maps the default initial guess
+# [A, l, w_0, theta_0, b, s] to the model parameters, 'expand' maps the
+# model parameters (or their errors) back to that layout; for 'two_freq'
+# that layout only holds the main component, so curves are evaluated from
+# 'Model' and 'model_params' (see population_model). 'jacobian' is the
+# analytic Jacobian passed to curve_fit, so each step evaluates exp, sin
+# and cos once instead of once per parameter for finite differences.
+FIT_MODELS = {
+    'full': {
+        'label': 'Decaying sine with slope',
+        'function': fit_function,
+        'jacobian': _jacobian_full,
+        'guess': lambda g: list(g),
+        'expand': lambda p: list(p),
+    },
+    'no_slope': {
+        'label': 'Decaying sine without slope',
+        'function': fit_function_no_slope,
+        'jacobian': _jacobian_no_slope,
+        'guess': lambda g: list(g[:5]),
+        'expand': lambda p: list(p) + [0],
+    },
+    'no_decay': {
+        'label': 'Sine without decay',
+        'function': fit_function_no_decay,
+        'jacobian': _jacobian_no_decay,
+        'guess': lambda g: [g[0], g[2], g[3], g[4], g[5]],
+        'expand': lambda p: [p[0], 0, p[1], p[2], p[3], p[4]],
+    },
+    'two_freq': {
+        'label': 'Decaying sine with second frequency',
+        'function': fit_function_two_freq,
+        'jacobian': _jacobian_two_freq,
+        'guess': lambda g: list(g) + [0.1 * g[0], 2 * g[2], 0],
+        'expand': lambda p: list(p[:6]),
+    },
+}
+
+
+def _fit_model(y, xpos, model='full', start=None, counts=None):
+    """
+    Fit one registered model and compile its statistics; raises on failure
+
+    start is an optional initial guess in the [A, l, w_0, theta_0, b, s]
+    layout; the default fixed guess is used when it is None. counts are the
+    optional numbers of rows behind each y when y are per-position means:
+    the fit then uses sigma = 1/sqrt(counts), which gives the parameters
+    of the fit to every row, and the statistics are weighted by counts.
+    """
+    spec = FIT_MODELS[model]
+    # Initial parameter guesses
+    if start is None:
+        max_a = np.max(y) * 1.1
+        guess_w_0 = 2*np.pi / 160
+        guess_theta_0 = -np.pi/2
+        guess_b = np.mean(y)
+        start = [max_a, 1/160, guess_w_0, guess_theta_0, guess_b, 0]
+    initial_guess = spec['guess'](start)
+
+    # Perform curve fitting
+    xpos = np.asarray(xpos, dtype=float)
+    weights = np.ones(len(y)) if counts is None else np.asarray(counts, dtype=float)
+    sigma = None if counts is None else 1 / np.sqrt(weights)
+    model_popt, model_pcov = optimize.curve_fit(spec['function'], xpos, y, p0=initial_guess,
+                                                sigma=sigma, jac=spec['jacobian'])
+    y_fit = spec['function'](xpos, *model_popt)
+    popt = np.array(spec['expand'](model_popt))
+    perr = np.array(spec['expand'](np.sqrt(np.diag(model_pcov))))
+
+    # Extract parameters
+    _, l_fit, w_0_fit, theta0_fit, _, _ = popt
+
+    # Calculate statistics
+    n, k = len(y), len(initial_guess)
+    spacing = 2*np.pi / w_0_fit
+    sst = np.sum(weights * (y - np.average(y, weights=weights))**2)
+    ssr = np.sum(weights * (y - y_fit)**2)
+    r2 = 1 - ssr/sst
+    adj_r2 = 1 - (1-r2)*(n-1)/(n-k-1)
+    decay = np.exp(-l_fit * spacing)
+
+    # Calculate errors
+    s_fit = popt[-1] * 1000
+    A_fit = popt[0]
+    b_fit = popt[-2]
+    adj_mean = np.average(y_fit, weights=weights)
+    err_A = perr[0]
+    err_s = perr[-1]*1000
+    err_w0 = perr[2]
+    err_spacing = 2*np.pi / (w_0_fit**2)*err_w0
+
+    # Compile results
+    result = {
+        'Adj.R2': adj_r2,
+        'Spacing': spacing,
+        'Error_spacing': err_spacing,
+        'Adj.Mean': adj_mean,
+        'Amplitude': A_fit,
+        'Error_Amp': err_A,
+        'Slope': s_fit,
+        'Error_Slope': err_s,
+        'Decay': decay,
+        'b0': b_fit,
+        'theta0': theta0_fit,
+        'AIC': n * np.log(ssr / n) + 2 * k,
+        'BIC': n * np.log(ssr / n) + k * np.log(n),
+        'Model': model,
+        'fit_params': popt,
+        'fit_errors': perr,
+        'model_params': model_popt,
+    }
+    return result
+
+
+def _score_start_grid(y, xpos, spacings, phases, decays, weights=None,
+        chunk_bytes: int=64 << 20):
+    """
+    Score a grid of (spacing, phase, decay) starts in one broadcast
+
+    For fixed spacing, phase and decay the model is linear in (A, b, s),
+    so the optimal linear terms and the SSE of every grid point follow from
+    batched 3x3 normal equations. With per-position means as y and the
+    number of rows per position as weights, the ranking equals that of the
+    full data. The grid is processed in chunks of about chunk_bytes.
+    Returns the starts in the [A, l, w_0, theta_0, b, s] layout, sorted by
+    SSE, and the sorted SSE (up to a constant with weights).
+    """
+    W, T, L = np.meshgrid(2*np.pi / np.asarray(spacings), np.asarray(phases),
+                          np.asarray(decays), indexing='ij')
+    W, T, L = W.ravel(), T.ravel(), L.ravel()
+    if weights is None:
+        weights = np.ones_like(y)
+    chunk = max(int(chunk_bytes // (4 * 8 * len(xpos))), 1)
+    coef = np.empty((len(W), 3))
+    sse = np.empty(len(W))
+    for i in range(0, len(W), chunk):
+        rows = slice(i, i + chunk)
+        wave = np.exp(-np.outer(L[rows], xpos)) * np.sin(np.outer(W[rows], xpos) + T[rows, None])
+        basis = np.stack([wave, np.ones_like(wave), np.broadcast_to(xpos, wave.shape)], axis=2)
+        gram = np.einsum('gni,n,gnj->gij', basis, weights, basis)
+        rhs = np.einsum('gni,n->gi', basis, weights * y)
+        coef[rows] = np.linalg.solve(gram + 1e-12 * np.eye(3), rhs[..., None])[..., 0]
+        resid = y - np.einsum('gni,gi->gn', basis, coef[rows])
+        sse[rows] = np.sum(weights * resid**2, axis=1)
+
+    # A negative amplitude is the same curve half a period out of phase
+    A, b, s = coef.T
+    T = np.where(A < 0, T + np.pi, T)
+    T = np.angle(np.exp(1j * T))
+    starts = np.column_stack([np.abs(A), L, W, T, b, s])
+    order = np.argsort(sse)
+    return starts[order], sse[order]
+
+
+def _fit_multistart(y, xpos, model='full', n_refine=6, max_workers=2,
+        spacing_tol=1.0, spacings=None, phases=None, decays=None, counts=None):
+    """
+    Multi-start fit: score a start grid, refine the best starts in parallel
+    and stop once two refinements agree on the spacing; raises on failure
+    """
+    y = np.asarray(y, dtype=float)
+    xpos = np.asarray(xpos, dtype=float)
+    weights = np.ones(len(y)) if counts is None else np.asarray(counts, dtype=float)
+    if spacings is None:
+        spacings = np.arange(120, 261, 10)
+    if phases is None:
+        phases = np.linspace(-np.pi, np.pi, 8, endpoint=False)
+    if decays is None:
+        decays = [0, 1/1000, 1/500, 1/250, 1/160, 1/100]
+    # Score the grid on per-position means; only the refinements use every row
+    positions, inverse = np.unique(xpos, return_inverse=True)
+    totals = np.bincount(inverse, weights=weights)
+    means = np.bincount(inverse, weights=weights * y) / totals
+    starts, _ = _score_start_grid(means, positions, spacings, phases, decays,
+                                  weights=totals)
+    starts = starts[:n_refine]
+
+    def refine(i):
+        try:
+            return i, _fit_model(y, xpos, model, start=starts[i], counts=counts)
+        except Exception:
+            return i, None
+
+    done = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(refine, i) for i in range(len(starts))]
+        for future in as_completed(futures):
+            i, result = future.result()
+            if result is None:
+                continue
+            agree = any(abs(other['Spacing'] - result['Spacing']) < spacing_tol
+                        for other in done.values())
+            done[i] = result
+            if agree:
+                for pending in futures:
+                    pending.cancel()
+                break
+
+    if not done:
+        raise RuntimeError("no start converged")
+    best = max(done, key=lambda i: done[i]['Adj.R2'])
+    result = dict(done[best])
+    result['Start_Index'] = best
+    result['Start_Params'] = starts[best]
+    result['N_Refinements'] = len(done)
+    return result
+
+
+# Playground parameters that can be swept
+SWEEP_PARAMETERS = ['Spacing', 'Decay', 'Amplitude', 'theta0']
+
+
+def sweep_curves(x, spacing, amplitude, decay, theta0, b, s, sweep, values,
+        envelopes: bool=True):
+    """
+    Compute the fit, upper and lower curves for a family of parameter values
+
+    Parameters are given as in the playground (spacing in bp, decay per
+    period, slope per bp). The swept parameter is replaced by a column of
+    values, so every curve of the family comes from one broadcast.
+
+    Parameters:
+    -----------
+    x : array-like
+        Input positions
+    spacing, amplitude, decay, theta0, b, s : float
+        Base parameter values
+    sweep : str
+        One of SWEEP_PARAMETERS
+    values : array-like
+        Values of the swept parameter
+    envelopes : bool
+        Also compute the upper and lower envelopes
+
+    Returns:
+    --------
+    dict
+        'fit' (and with envelopes 'upper' and 'lower') arrays of shape
+        (len(values), len(x))
+    """
+    params = {'Spacing': spacing, 'Decay': decay, 'Amplitude': amplitude,
+              'theta0': theta0}
+    params[sweep] = np.asarray(values, dtype=float)[:, None]
+    for name in ('Spacing', 'Decay'):
+        if np.any(np.asarray(params[name]) <= 0):
+            raise ValueError(f"{name} must be positive")
+    x = np.asarray(x, dtype=float)[None, :]
+    w_0 = 2 * np.pi / params['Spacing']
+    l = -np.log(params['Decay']) / params['Spacing']
+    shape = (len(values), x.shape[1])
+    curves = {'fit': np.broadcast_to(fit_function(x, params['Amplitude'], l, w_0,
+                                                  params['theta0'], b, s), shape)}
+    if envelopes:
+        curves['upper'] = np.broadcast_to(upper_function(x, params['Amplitude'], l, b, s), shape)
+        curves['lower'] = np.broadcast_to(lower_function(x, params['Amplitude'], l, b, s), shape)
+    return curves
+
+
+def calc_sine_fit(y, xpos, model='full', multistart=False, start=None, counts=None):
     """
     Calculate sine wave fit parameters and statistics
     
@@ -49,73 +379,160 @@ def calc_sine_fit(y, xpos):
         Input y values
     xpos : array-like
         Input x positions
+    model : str
+        Key of the model in FIT_MODELS
+    multistart : bool
+        Refine the best starts of a (spacing, phase, decay) grid instead of
+        the single fixed initial guess
+    start : array-like
+        Initial guess in the [A, l, w_0, theta_0, b, s] layout, e.g. the
+        fit_params of a coarse fit (ignored with multistart)
+    counts : array-like
+        Number of rows behind each y when y are per-position means
     
     Returns:
     --------
     dict
         Dictionary containing fit parameters and statistics
     """
-    # Initial parameter guesses
-    max_a = np.max(y) * 1.1
-    guess_w_0 = 2*np.pi / 160
-    guess_theta_0 = -np.pi/2
-    guess_b = np.mean(y)
-    initial_guess = [max_a, 1/160, guess_w_0, guess_theta_0, guess_b, 0]
-    
-    # Perform curve fitting
     try:
-        popt, pcov = curve_fit(fit_function, xpos, y, p0=initial_guess)
-        y_fit = fit_function(xpos, *popt)
-        
-        # Extract parameters
-        _, l_fit, w_0_fit, theta0_fit, _, _ = popt
-        
-        # Calculate statistics
-        spacing = 2*np.pi / w_0_fit
-        sst = np.sum((y-np.mean(y))**2)
-        ssr = np.sum((y-y_fit)**2)
-        r2 = 1 - ssr/sst
-        adj_r2 = 1 - (1-r2)*(len(y)-1)/(len(y)-len(initial_guess)-1)
-        decay = np.exp(-l_fit * spacing)
-        
-        # Calculate errors
-        perr = np.sqrt(np.diag(pcov))
-        s_fit = popt[-1] * 1000
-        A_fit = popt[0]
-        b_fit = popt[-2]
-        adj_mean = np.mean(y_fit)
-        err_A = perr[0]
-        err_s = perr[-1]*1000
-        err_w0 = perr[2]
-        err_spacing = 2*np.pi / (w_0_fit**2)*err_w0
-        
-        # Compile results
-        result = {
-            'Adj.R2': adj_r2,
-            'Spacing': spacing,
-            'Error_spacing': err_spacing,
-            'Adj.Mean': adj_mean,
-            'Amplitude': A_fit,
-            'Error_Amp': err_A,
-            'Slope': s_fit,
-            'Error_Slope': err_s,
-            'Decay': decay,
-            'b0': b_fit,
-            'theta0': theta0_fit,
-            'fit_params': popt,
-            'fit_errors': perr
-        }
-        return result
-    
+        if multistart:
+            return _fit_multistart(y, xpos, model, counts=counts)
+        return _fit_model(y, xpos, model, start=start, counts=counts)
     except Exception as e:
         st.error(f"Fitting failed: {str(e)}")
         return None
 
 
-def calculate_adj_gene_level(y, xpos, fit_params):
+def calc_model_selection(y, xpos, models=None, criterion='BIC', max_workers=None,
+        multistart=False, counts=None):
+    """
+    Fit several registered models concurrently and rank them
+
+    Parameters:
+    -----------
+    y : array-like
+        Input y values
+    xpos : array-like
+        Input x positions
+    models : list
+        Keys of FIT_MODELS to compare (default: all)
+    criterion : str
+        'AIC' or 'BIC', lower is better
+    max_workers : int
+        Number of fitting threads (default: one per model)
+    multistart : bool
+        Use the multi-start fit for every model
+    counts : array-like
+        Number of rows behind each y when y are per-position means
+
+    Returns:
+    --------
+    dict
+        Fitting result of the winning model with an added 'Model_Ranking'
+        list (one record per candidate, best first)
+    """
+    try:
+        best, failures = _select_model(y, xpos, models, criterion, max_workers, multistart,
+                                       counts)
+    except RuntimeError as e:
+        st.error(str(e))
+        return None
+    for model, error in failures.items():
+        st.warning(f"Fitting {FIT_MODELS[model]['label']} failed: {error}")
+    return best
+
+
+def _select_model(y, xpos, models=None, criterion='BIC', max_workers=None,
+        multistart=False, counts=None):
+    """
+    Core of calc_model_selection; returns (best_result, failures) where
+    failures maps each failed model to its error, and raises RuntimeError
+    when every candidate failed
+    """
+    models = list(FIT_MODELS) if models is None else list(models)
+    y = np.asarray(y, dtype=float)
+    xpos = np.asarray(xpos, dtype=float)
+
+    def fit_one(model):
+        try:
+            if multistart:
+                return model, _fit_multistart(y, xpos, model, counts=counts), None
+            return model, _fit_model(y, xpos, model, counts=counts), None
+        except Exception as e:
+            return model, None, str(e)
+
+    with ThreadPoolExecutor(max_workers=max_workers or len(models)) as executor:
+        fits = list(executor.map(fit_one, models))
+
+    results = {model: result for model, result, _ in fits if result is not None}
+    failures = {model: error for model, _, error in fits if error is not None}
+    if not results:
+        raise RuntimeError("Fitting failed for all candidate models: " + "; ".join(
+            f"{model}: {error}" for model, error in failures.items()))
+
+    ranked = sorted(results, key=lambda m: results[m][criterion])
+    best_score = results[ranked[0]][criterion]
+    ranking = [{
+        'Model': model,
+        'Label': FIT_MODELS[model]['label'],
+        'Parameters': len(results[model]['model_params']),
+        'Adj.R2': float(results[model]['Adj.R2']),
+        'AIC': float(results[model]['AIC']),
+        'BIC': float(results[model]['BIC']),
+        f'Delta_{criterion}': float(results[model][criterion] - best_score),
+    } for model in ranked]
+
+    best = dict(results[ranked[0]])
+    best['Model_Ranking'] = ranking
+    return best, failures
+
+
+def fit_phasing_profile(ydata, xdata, models: list=None, criterion: str='BIC',
+        multistart: bool=False, start_result: dict=None, counts=None):
+    """
+    Fit one filtered profile with the options of process_data, raising on
+    failure instead of reporting to the page; counts weight per-position
+    means by their numbers of rows
+
+    Returns:
+    --------
+    dict
+        Fitting result; with several models, the errors of failed
+        candidates are listed under 'Failed_Models'
+    """
+    if start_result is not None:
+        return _fit_model(ydata, xdata, start_result['Model'],
+                          start=start_result['fit_params'], counts=counts)
+    if models is None or len(models) == 1:
+        model = 'full' if models is None else models[0]
+        if multistart:
+            return _fit_multistart(ydata, xdata, model, counts=counts)
+        return _fit_model(ydata, xdata, model, counts=counts)
+    best, failures = _select_model(ydata, xdata, models=models, criterion=criterion,
+                                   multistart=multistart, counts=counts)
+    if failures:
+        best['Failed_Models'] = failures
+    return best
+
+
+def population_model(fit_results):
+    """
+    Model key and model parameters of a population fitting result
+
+    Results without 'model_params' (e.g. parameters entered by hand) are
+    evaluated with the full model on their 'fit_params'.
+    """
+    result = fit_results['results']
+    if 'model_params' in result:
+        return result.get('Model', 'full'), np.asarray(result['model_params'])
+    return 'full', np.asarray(result['fit_params'])
+
+
+def calculate_adj_gene_level(y, xpos, fit_params, model='full'):
     popt = fit_params
     def fit_f(x):
-        return fit_function(x, *popt)
+        return FIT_MODELS[model]['function'](x, *popt)
     y_fit = fit_f(xpos)
     adj_rate = np.nanmean(y - y_fit)
     sst = np.sum((y - np.mean(y))**2)
@@ -124,7 +541,9 @@ def calculate_adj_gene_level(y, xpos, fit_params):
     return adj_rate, r2
 
 
-def process_data(df: pd.DataFrame, xmin: int=-50, xmax: int=1000):
+def process_data(df: pd.DataFrame, xmin: int=-50, xmax: int=1000,
+        models: list=None, criterion: str='BIC', multistart: bool=False,
+        start_result: dict=None):
     """
     Process the DataFrame for phasing analysis
     
@@ -132,11 +551,23 @@ def process_data(df: pd.DataFrame, xmin: int=-50, xmax: int=1000):
     -----------
     df : pandas.DataFrame
         Input dataframe containing methylation data
-        Must have columns: 'Pos', 'Value'
+        Must have columns: 'Pos', 'Value'; with a 'Count' column (as from
+        aggregate_profile) the values are per-position means and the fit
+        is weighted by the counts
     xmin : int
         Minimum x value to include in analysis
     xmax : int
         Maximum x value to include in analysis
+    models : list
+        Keys of FIT_MODELS to compare; a single model is fitted directly,
+        and the default model when None
+    criterion : str
+        Information criterion used to rank the models ('AIC' or 'BIC')
+    multistart : bool
+        Use the multi-start fit instead of the single fixed initial guess
+    start_result : dict
+        Earlier fitting result to warm-start from; its model is refitted
+        and models/multistart are ignored
         
     Returns:
     --------
@@ -158,7 +589,16 @@ def process_data(df: pd.DataFrame, xmin: int=-50, xmax: int=1000):
         # Perform fitting
         ydata = df['Value'].values
         xdata = df['Pos'].values
-        result_dict = calc_sine_fit(ydata, xdata)
+        counts = df['Count'].values if 'Count' in df.columns else None
+        try:
+            result_dict = fit_phasing_profile(ydata, xdata, models=models,
+                                              criterion=criterion, multistart=multistart,
+                                              start_result=start_result, counts=counts)
+        except Exception as e:
+            st.error(f"Fitting failed: {str(e)}")
+            result_dict = None
+        for model, error in (result_dict or {}).pop('Failed_Models', {}).items():
+            st.warning(f"Fitting {FIT_MODELS[model]['label']} failed: {error}")
         
         return df, result_dict
     
@@ -167,6 +607,132 @@ def process_data(df: pd.DataFrame, xmin: int=-50, xmax: int=1000):
         return None, None
 
 
+def aggregate_profile(df: pd.DataFrame, xmin: int=-50, xmax: int=1000,
+        max_points: int=1100):
+    """
+    Aggregate the data to per-position means for a fast preliminary fit
+
+    Parameters:
+    -----------
+    df : pandas.DataFrame
+        Input dataframe with columns: 'Pos', 'Value'
+    xmin : int
+        Minimum x value to include in analysis
+    xmax : int
+        Maximum x value to include in analysis
+    max_points : int
+        Upper bound on the number of aggregated points; positions are
+        pooled into wider bins when the range is longer
+
+    Returns:
+    --------
+    agg_pd: pandas.DataFrame
+        Output dataframe with columns: 'Pos', 'Value', 'Count'
+    """
+    pos = df['Pos'].values.astype(int)
+    mask = (pos >= xmin) & (pos <= xmax)
+    bin_size = max(int(np.ceil((xmax - xmin + 1) / max_points)), 1)
+    bins = (pos[mask] - xmin) // bin_size
+    n_bins = (xmax - xmin) // bin_size + 1
+    sums = np.bincount(bins, weights=df['Value'].values[mask], minlength=n_bins)
+    counts = np.bincount(bins, minlength=n_bins)
+    has_data = counts > 0
+    centers = xmin + np.arange(n_bins) * bin_size + (bin_size - 1) // 2
+    agg_pd = pd.DataFrame({
+        'Pos': centers[has_data],
+        'Value': sums[has_data] / counts[has_data],
+        'Count': counts[has_data],
+    })
+    return agg_pd
+
+
+def fit_preliminary(df: pd.DataFrame, xmin: int=-50, xmax: int=1000,
+        latency_budget: float=1.0, min_points: int=128, max_points: int=1100,
+        **fit_options):
+    """
+    Coarse-to-fine preliminary fit within a latency budget
+
+    The first level fits min_points per-position aggregates with the full
+    fit options (model selection, multi-start). Each next level has four
+    times more points and is warm-started from the previous result. A
+    level runs only while the time spent so far plus its predicted cost
+    (the previous level's cost scaled by the point count) fits the budget.
+
+    Parameters:
+    -----------
+    df : pandas.DataFrame
+        Input dataframe with columns: 'Pos', 'Value'
+    xmin : int
+        Minimum x value to include in analysis
+    xmax : int
+        Maximum x value to include in analysis
+    latency_budget : float
+        Target time (s) until the preliminary result is available
+    min_points, max_points : int
+        Aggregation of the first and of the finest level
+    fit_options :
+        models, criterion and multistart as in process_data
+
+    Returns:
+    --------
+    tuple
+        (aggregated_dataframe, result_dictionary, info) where info holds
+        'Points', 'Levels', 'Elapsed' and 'Budget'; None on failure
+    """
+    start_time = time.perf_counter()
+    n_points = min_points
+    agg_df = aggregate_profile(df, xmin=xmin, xmax=xmax, max_points=n_points)
+    processed = process_data(agg_df, xmin=xmin, xmax=xmax, **fit_options)
+    if processed is None or processed[1] is None:
+        return None
+    result = processed[1]
+    levels = 1
+    level_cost = time.perf_counter() - start_time
+    while n_points < max_points:
+        next_points = min(4 * n_points, max_points)
+        elapsed = time.perf_counter() - start_time
+        if elapsed + level_cost * next_points / n_points > latency_budget:
+            break
+        level_start = time.perf_counter()
+        next_df = aggregate_profile(df, xmin=xmin, xmax=xmax, max_points=next_points)
+        processed = process_data(next_df, xmin=xmin, xmax=xmax, start_result=result)
+        if processed is None or processed[1] is None:
+            break
+        # The ranking of the candidates comes from the first level
+        ranking = result.get('Model_Ranking')
+        agg_df, result = next_df, processed[1]
+        if ranking is not None:
+            result['Model_Ranking'] = ranking
+        n_points, levels = next_points, levels + 1
+        level_cost = time.perf_counter() - level_start
+
+    info = {
+        'Points': len(agg_df),
+        'Levels': levels,
+        'Elapsed': time.perf_counter() - start_time,
+        'Budget': latency_budget,
+    }
+    return agg_df, result, info
+
+
+def compare_fit_results(prelim: dict, final: dict):
+    """
+    Tabulate how much the main fit metrics moved between two fits
+
+    Returns:
+    --------
+    pandas.DataFrame
+        Columns: 'Metric', 'Preliminary', 'Final', 'Change', 'Change (%)'
+    """
+    rows = []
+    for key in ['Spacing', 'Amplitude', 'Decay', 'Slope', 'theta0', 'b0', 'Adj.R2']:
+        before, after = float(prelim[key]), float(final[key])
+        rel = 100 * (after - before) / abs(before) if before != 0 else np.nan
+        rows.append((key, before, after, after - before, rel))
+    return pd.DataFrame(rows, columns=['Metric', 'Preliminary', 'Final',
+                                       'Change', 'Change (%)'])
+
+
 def process_gene_data(df: pd.DataFrame, fit_results: dict, 
         xmin: int=-50, xmax: int=1000):
     """
@@ -189,7 +755,7 @@ def process_gene_data(df: pd.DataFrame, fit_results: dict,
     gene_pd: pandas.DataFrame
         Output dataframe with columns: 'Gene', 'Adj.Average'
     """
-    fit_params = fit_results['results']['fit_params']
+    model, fit_params = population_model(fit_results)
     # Ensure required columns exist
     required_columns = ['Gene', 'Pos', 'Value']
     if not all(col in df.columns for col in required_columns):
@@ -204,7 +770,7 @@ def process_gene_data(df: pd.DataFrame, fit_results: dict,
         for gene, tmp_pd in df.groupby(by='Gene', sort=False):
             y = tmp_pd['Value'].values
             xpos = tmp_pd['Pos'].values
-            adj_rate, r2 = calculate_adj_gene_level(y, xpos, fit_params)
+            adj_rate, r2 = calculate_adj_gene_level(y, xpos, fit_params, model)
             gene_pd.append((gene, adj_rate, r2))
         gene_pd = pd.DataFrame(gene_pd, columns=['Gene', 'Adj.Average', 'R2'])
 
@@ -215,6 +781,1241 @@ def process_gene_data(df: pd.DataFrame, fit_results: dict,
         return None
 
 
+def build_sort_index(gene_df: pd.DataFrame):
+    """
+    Precompute the ascending row order of every numeric column
+
+    Returns:
+    --------
+    dict
+        Column name -> integer positions of the rows in ascending order
+        (NaN last)
+    """
+    return {col: np.argsort(gene_df[col].values, kind='stable')
+            for col in gene_df.columns if pd.api.types.is_numeric_dtype(gene_df[col])}
+
+
+def gene_table_mask(gene_df: pd.DataFrame, min_r2: float=None, search: str=''):
+    """
+    Boolean mask of the genes passing the R2 threshold and name search
+
+    Parameters:
+    -----------
+    gene_df : pandas.DataFrame
+        Gene table from process_gene_data
+    min_r2 : float
+        Keep genes with R2 >= min_r2 (optional)
+    search : str
+        Case-insensitive substring filter on the gene name
+
+    Returns:
+    --------
+    numpy.ndarray
+        One bool per row of gene_df
+    """
+    keep = np.ones(len(gene_df), dtype=bool)
+    if min_r2 is not None:
+        keep &= gene_df['R2'].values >= min_r2
+    if search:
+        keep &= gene_df['Gene'].astype(str).str.contains(
+            search, case=False, regex=False).values
+    return keep
+
+
+def query_gene_table(gene_df: pd.DataFrame, sort_index: dict, sort_by: str='Adj.Average',
+        ascending: bool=False, min_r2: float=None, search: str='', top_n: int=0,
+        page: int=1, page_size: int=50, keep=None):
+    """
+    Return one sorted, filtered page of the gene result table
+
+    Sorting uses the precomputed sort_index, so only the rows of the
+    requested page are materialized. The page is clamped to the existing
+    pages.
+
+    Parameters:
+    -----------
+    gene_df : pandas.DataFrame
+        Gene table from process_gene_data
+    sort_index : dict
+        Output of build_sort_index(gene_df)
+    sort_by : str
+        Column to sort by
+    ascending : bool
+        Sort order
+    min_r2 : float
+        Keep genes with R2 >= min_r2 (optional)
+    search : str
+        Case-insensitive substring filter on the gene name
+    top_n : int
+        Keep only the first top_n genes after sorting and filtering (0: all)
+    page : int
+        1-based page number
+    page_size : int
+        Number of rows per page
+    keep : numpy.ndarray
+        Precomputed gene_table_mask(gene_df, min_r2, search); min_r2 and
+        search are ignored when it is given
+
+    Returns:
+    --------
+    tuple
+        (page_dataframe, number_of_matching_genes)
+    """
+    order = sort_index[sort_by]
+    if not ascending:
+        # Reverse while keeping NaN at the end
+        n_nan = int(np.isnan(gene_df[sort_by].values).sum())
+        order = np.concatenate([order[:len(order) - n_nan][::-1],
+                                order[len(order) - n_nan:]])
+    if keep is None:
+        keep = gene_table_mask(gene_df, min_r2=min_r2, search=search)
+    rows = order[keep[order]]
+    if top_n > 0:
+        rows = rows[:top_n]
+    n_pages = max(int(np.ceil(len(rows) / page_size)), 1)
+    start = (min(max(page, 1), n_pages) - 1) * page_size
+    return gene_df.iloc[rows[start:start + page_size]], len(rows)
+
+
+def build_gene_matrix(df: pd.DataFrame, xmin: int=-50, xmax: int=1000):
+    """
+    Pivot long-format gene data into a dense gene x position matrix
+
+    Parameters:
+    -----------
+    df : pandas.DataFrame
+        Input dataframe with columns: 'Gene', 'Pos', 'Value'
+    xmin : int
+        Minimum x value to include
+    xmax : int
+        Maximum x value to include
+
+    Returns:
+    --------
+    tuple
+        (genes, positions, matrix) where matrix has one row per gene and
+        one column per bp in [xmin, xmax]; missing positions are NaN and
+        duplicated (Gene, Pos) rows are averaged
+    """
+    pos = df['Pos'].values.astype(int)
+    mask = (pos >= xmin) & (pos <= xmax)
+    gene_codes, genes = pd.factorize(df['Gene'].values[mask], sort=False)
+    positions = np.arange(xmin, xmax + 1)
+    n_pos = len(positions)
+    flat = gene_codes * n_pos + (pos[mask] - xmin)
+    size = len(genes) * n_pos
+    sums = np.bincount(flat, weights=df['Value'].values[mask], minlength=size)
+    counts = np.bincount(flat, minlength=size)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        matrix = np.where(counts > 0, sums / counts, np.nan)
+    return genes, positions, matrix.reshape(len(genes), n_pos)
+
+
+def calculate_adj_gene_matrix(positions, matrix, fit_params, model='full'):
+    """
+    Vectorized calculate_adj_gene_level for every row of a gene matrix
+
+    Parameters:
+    -----------
+    positions : array-like
+        Column positions of the matrix
+    matrix : numpy.ndarray
+        Gene x position values from build_gene_matrix (NaN where missing)
+    fit_params : array-like
+        Population fit parameters of the model
+    model : str
+        Key of the population model in FIT_MODELS
+
+    Returns:
+    --------
+    tuple
+        (residual_matrix, adj_rate, r2, n_positions) with one entry per gene
+    """
+    y_fit = FIT_MODELS[model]['function'](np.asarray(positions, dtype=float), *fit_params)
+    resid = matrix - y_fit
+    valid = ~np.isnan(matrix)
+    n = valid.sum(axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        adj_rate = np.nansum(resid, axis=1) / n
+        y_mean = np.nansum(matrix, axis=1) / n
+        sst = np.nansum((matrix - y_mean[:, None])**2, axis=1)
+        ssr = np.nansum((resid - adj_rate[:, None])**2, axis=1)
+        r2 = 1 - ssr / sst
+    return resid, adj_rate, r2, n
+
+
+def process_differential_gene_data(df_a: pd.DataFrame, fit_results_a: dict,
+        df_b: pd.DataFrame, fit_results_b: dict, labels=('WT', 'Mutant'),
+        xmin: int=-50, xmax: int=1000, n_boot: int=200, seed: int=None):
+    """
+    Differential phasing of every gene between two conditions
+
+    Each condition is adjusted against its own population fit as in
+    process_gene_data. Genes are aligned with a join index, the per-gene
+    statistics are computed as row reductions of the gene x position
+    matrices, and significance comes from a Poisson bootstrap over
+    positions evaluated for all genes and resamples as one matrix product
+    per condition.
+
+    Parameters:
+    -----------
+    df_a, df_b : pandas.DataFrame
+        Gene tables with columns: 'Gene', 'Pos', 'Value'
+    fit_results_a, fit_results_b:
+        Population fitting results of each condition
+    labels : tuple
+        Condition names used in the column names
+    xmin : int
+        Minimum x value to include in analysis
+    xmax : int
+        Maximum x value to include in analysis
+    n_boot : int
+        Number of bootstrap resamples
+    seed : int
+        Seed of the random generator
+
+    Returns:
+    --------
+    diff_pd: pandas.DataFrame
+        One row per shared gene, ranked by P_value, with the adjusted
+        average and R2 of each condition, their deltas (b - a), the
+        bootstrap standard error, P_value and Benjamini-Hochberg Q_value
+    """
+    required_columns = ['Gene', 'Pos', 'Value']
+    for df in (df_a, df_b):
+        if not all(col in df.columns for col in required_columns):
+            st.error("CSV must contain columns: 'Gene', 'Pos', 'Value'")
+            return None
+    if labels[0] == labels[1]:
+        st.error("The two conditions need different labels")
+        return None
+
+    try:
+        genes_a, positions, mat_a = build_gene_matrix(df_a, xmin=xmin, xmax=xmax)
+        genes_b, _, mat_b = build_gene_matrix(df_b, xmin=xmin, xmax=xmax)
+
+        # Join index of the genes present in both conditions
+        idx_b = pd.Index(genes_b).get_indexer(genes_a)
+        shared = idx_b >= 0
+        genes = np.asarray(genes_a)[shared]
+        mat_a, mat_b = mat_a[shared], mat_b[idx_b[shared]]
+
+        model_a, params_a = population_model(fit_results_a)
+        model_b, params_b = population_model(fit_results_b)
+        resid_a, adj_a, r2_a, n_a = calculate_adj_gene_matrix(
+            positions, mat_a, params_a, model_a)
+        resid_b, adj_b, r2_b, n_b = calculate_adj_gene_matrix(
+            positions, mat_b, params_b, model_b)
+        delta = adj_b - adj_a
+
+        # Poisson bootstrap over positions: weighted means for all genes at once
+        rng = np.random.default_rng(seed)
+        boot = []
+        for resid in (resid_a, resid_b):
+            weights = rng.poisson(1.0, size=(len(positions), n_boot)).astype(float)
+            valid = ~np.isnan(resid)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                boot.append((np.where(valid, resid, 0.0) @ weights) / (valid @ weights))
+        boot_delta = boot[1] - boot[0]
+        se = np.nanstd(boot_delta, axis=1, ddof=1)
+        # Two-sided normal p-value from the bootstrap standard error
+        with np.errstate(invalid='ignore', divide='ignore'):
+            p_value = 2 * special.ndtr(-np.abs(delta) / se)
+        p_value = np.where(np.isnan(p_value), 1.0, p_value)
+
+        # Benjamini-Hochberg adjusted p-values
+        order = np.argsort(p_value)
+        ranked = p_value[order] * len(p_value) / np.arange(1, len(p_value) + 1)
+        q_value = np.empty_like(p_value)
+        q_value[order] = np.minimum(1.0, np.minimum.accumulate(ranked[::-1])[::-1])
+
+        label_a, label_b = labels
+        diff_pd = pd.DataFrame({
+            'Gene': genes,
+            f'Adj.Average_{label_a}': adj_a,
+            f'Adj.Average_{label_b}': adj_b,
+            'Delta.Adj.Average': delta,
+            f'R2_{label_a}': r2_a,
+            f'R2_{label_b}': r2_b,
+            'Delta.R2': r2_b - r2_a,
+            'SE': se,
+            'P_value': p_value,
+            'Q_value': q_value,
+        })
+        diff_pd = diff_pd.iloc[np.lexsort((-np.abs(delta), p_value))].reset_index(drop=True)
+        diff_pd.insert(0, 'Rank', np.arange(1, len(diff_pd) + 1))
+        return diff_pd
+
+    except Exception as e:
+        st.error(f"Differential analysis failed: {str(e)}")
+        return None
+
+
+def _spectral_peak(spec, freqs, band):
+    """
+    Locate the dominant peak of each spectrum row within a frequency band
+
+    The peak frequency is refined by parabolic interpolation between the
+    neighbouring bins. Returns (peak_index, peak_frequency, peak_power).
+    """
+    band_spec = spec[:, band]
+    rows = np.arange(len(spec))
+    peak = np.clip(np.argmax(band_spec, axis=1), 1, len(band) - 2)
+    left, mid, right = (band_spec[rows, peak - 1], band_spec[rows, peak],
+                        band_spec[rows, peak + 1])
+    denom = left - 2 * mid + right
+    with np.errstate(invalid='ignore', divide='ignore'):
+        delta = np.where(denom < 0, 0.5 * (left - right) / denom, 0.0)
+    peak_freq = freqs[band[peak]] + np.clip(delta, -0.5, 0.5) * (freqs[1] - freqs[0])
+    return band[peak], peak_freq, mid
+
+
+def estimate_gene_spacing_spectral(df: pd.DataFrame, fit_results: dict,
+        xmin: int=-50, xmax: int=1000, min_spacing: float=100,
+        max_spacing: float=300, batch_size: int=2048):
+    """
+    Fast per-gene spacing estimation from a batched FFT
+
+    Each gene profile is detrended against the population baseline
+    (b0 + slope * x) and its own mean, then all genes are transformed in
+    one windowed, zero-padded FFT per batch. No per-gene curve fitting is
+    performed.
+
+    Parameters:
+    -----------
+    df : pandas.DataFrame
+        Input dataframe containing methylation data
+        Must have columns: 'Gene', 'Pos', 'Value'
+    fit_results:
+        Fitting result from phasing analysis
+    xmin : int
+        Minimum x value to include in analysis
+    xmax : int
+        Maximum x value to include in analysis
+    min_spacing, max_spacing : float
+        Range of nucleosome spacings (bp) searched for the spectral peak
+    batch_size : int
+        Number of genes transformed at once
+
+    Returns:
+    --------
+    spectral_pd: pandas.DataFrame
+        Output dataframe with columns: 'Gene', 'Spacing', 'Spectral.Power',
+        'Phasing.Strength', 'Coverage'
+    """
+    fit_params = fit_results['results']['fit_params']
+    # Ensure required columns exist
+    required_columns = ['Gene', 'Pos', 'Value']
+    if not all(col in df.columns for col in required_columns):
+        st.error("CSV must contain columns: 'Gene', 'Pos', 'Value'")
+        return None
+
+    try:
+        genes, positions, matrix = build_gene_matrix(df, xmin=xmin, xmax=xmax)
+        _, _, _, _, b_fit, s_fit = fit_params
+        baseline = b_fit + s_fit * positions
+
+        n_pos = len(positions)
+        n_fft = 1 << int(np.ceil(np.log2(2 * n_pos)))
+        freqs = np.fft.rfftfreq(n_fft)
+        band = np.flatnonzero((freqs >= 1 / max_spacing) & (freqs <= 1 / min_spacing))
+        # Half-width (in padded bins) of one native frequency bin
+        half_width = max(n_fft // n_pos, 1)
+        window = np.hanning(n_pos)
+
+        spacing = np.full(len(genes), np.nan)
+        power = np.full(len(genes), np.nan)
+        strength = np.full(len(genes), np.nan)
+        coverage = np.zeros(len(genes))
+        for start in range(0, len(genes), batch_size):
+            block = matrix[start:start + batch_size] - baseline
+            valid = ~np.isnan(block)
+            n_valid = valid.sum(axis=1)
+            with np.errstate(invalid='ignore'):
+                gene_mean = np.nansum(block, axis=1) / n_valid
+            resid = np.where(valid, block - gene_mean[:, None], 0.0) * window
+            spec = np.abs(np.fft.rfft(resid, n=n_fft, axis=1))**2
+
+            # Dominant peak in the spacing band
+            peak_idx, peak_freq, mid = _spectral_peak(spec, freqs, band)
+            rows = np.arange(len(block))
+
+            # Fraction of non-DC residual power concentrated around the peak
+            cum = np.cumsum(spec, axis=1)
+            lo = np.maximum(peak_idx - half_width, 1)
+            hi = np.minimum(peak_idx + half_width, spec.shape[1] - 1)
+            peak_band = cum[rows, hi] - cum[rows, lo - 1]
+            total = cum[:, -1] - cum[:, 0]
+            window_energy = (valid * window**2).sum(axis=1)
+
+            ok = (n_valid > 1) & (total > 0)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                spacing[start:start + len(block)] = np.where(ok, 1 / peak_freq, np.nan)
+                power[start:start + len(block)] = np.where(ok, mid / window_energy, np.nan)
+                strength[start:start + len(block)] = np.where(ok, peak_band / total, np.nan)
+            coverage[start:start + len(block)] = n_valid / n_pos
+
+        spectral_pd = pd.DataFrame({
+            'Gene': genes,
+            'Spacing': spacing,
+            'Spectral.Power': power,
+            'Phasing.Strength': strength,
+            'Coverage': coverage,
+        })
+        return spectral_pd
+
+    except Exception as e:
+        st.error(f"Spectral estimation failed: {str(e)}")
+        return None
+
+
+def _block_mean(matrix, row_size: int=1, col_size: int=1):
+    """
+    NaN-aware mean over row_size x col_size blocks of a matrix
+
+    The last block of each axis may be shorter; blocks without data are NaN.
+    """
+    n_rows = int(np.ceil(matrix.shape[0] / row_size))
+    n_cols = int(np.ceil(matrix.shape[1] / col_size))
+    padded = np.pad(matrix, ((0, n_rows * row_size - matrix.shape[0]),
+                             (0, n_cols * col_size - matrix.shape[1])),
+                    constant_values=np.nan)
+    blocks = padded.reshape(n_rows, row_size, n_cols, col_size)
+    counts = (~np.isnan(blocks)).sum(axis=(1, 3))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(counts > 0, np.nansum(blocks, axis=(1, 3)) / counts, np.nan)
+
+
+def bin_gene_matrix(positions, matrix, bin_size: int=10):
+    """
+    Average a gene x position matrix over consecutive position bins
+
+    Parameters:
+    -----------
+    positions : array-like
+        Column positions of the matrix
+    matrix : numpy.ndarray
+        Gene x position values (NaN where missing)
+    bin_size : int
+        Number of positions per bin (the last bin may be shorter)
+
+    Returns:
+    --------
+    tuple
+        (bin_centers, binned_matrix) with NaN for bins without data
+    """
+    positions = np.asarray(positions, dtype=float)
+    centers = _block_mean(positions[None, :], col_size=bin_size)[0]
+    return centers, _block_mean(matrix, col_size=bin_size)
+
+
+def _randomized_svd(X, n_components, n_oversamples=10, n_iter=4, rng=None):
+    """
+    Truncated SVD of X from a randomized range finder with power iterations
+    """
+    rng = np.random.default_rng(rng)
+    k = min(n_components + n_oversamples, *X.shape)
+    Q = X @ rng.standard_normal((X.shape[1], k))
+    for _ in range(n_iter):
+        Q, _ = np.linalg.qr(Q)
+        Q, _ = np.linalg.qr(X.T @ Q)
+        Q = X @ Q
+    Q, _ = np.linalg.qr(Q)
+    U_b, S, Vt = np.linalg.svd(Q.T @ X, full_matrices=False)
+    n_components = min(n_components, k)
+    return (Q @ U_b)[:, :n_components], S[:n_components], Vt[:n_components]
+
+
+def _minibatch_kmeans(X, n_clusters, batch_size=1024, n_iter=100, tol=1e-4, rng=None):
+    """
+    Mini-batch k-means with k-means++ seeding on a sample of X
+
+    Returns:
+    --------
+    tuple
+        (centers, labels, inertia)
+    """
+    rng = np.random.default_rng(rng)
+    n = len(X)
+    # k-means++ seeding on a sample
+    sample = X[rng.choice(n, size=min(n, 20 * batch_size), replace=False)]
+    centers = [sample[rng.integers(len(sample))]]
+    dist = ((sample - centers[0])**2).sum(axis=1)
+    for _ in range(1, n_clusters):
+        prob = dist / dist.sum() if dist.sum() > 0 else None
+        centers.append(sample[rng.choice(len(sample), p=prob)])
+        dist = np.minimum(dist, ((sample - centers[-1])**2).sum(axis=1))
+    centers = np.array(centers)
+
+    # Per-center learning rates decay with the number of points assigned
+    counts = np.zeros(n_clusters)
+    for _ in range(n_iter):
+        batch = X[rng.integers(n, size=min(batch_size, n))]
+        d = ((batch[:, None, :] - centers[None])**2).sum(axis=2)
+        nearest = d.argmin(axis=1)
+        previous = centers.copy()
+        batch_counts = np.bincount(nearest, minlength=n_clusters)
+        sums = np.zeros_like(centers)
+        np.add.at(sums, nearest, batch)
+        hit = batch_counts > 0
+        counts[hit] += batch_counts[hit]
+        eta = batch_counts[hit] / counts[hit]
+        centers[hit] = (1 - eta[:, None]) * centers[hit] + \
+            eta[:, None] * sums[hit] / batch_counts[hit, None]
+        if ((centers - previous)**2).sum() <= tol * ((previous**2).sum() + 1e-12):
+            break
+
+    # Final assignment of every point
+    labels = np.empty(n, dtype=int)
+    inertia = 0.0
+    for start in range(0, n, 8 * batch_size):
+        block = X[start:start + 8 * batch_size]
+        d = ((block[:, None, :] - centers[None])**2).sum(axis=2)
+        labels[start:start + len(block)] = d.argmin(axis=1)
+        inertia += d.min(axis=1).sum()
+    return centers, labels, inertia
+
+
+def cluster_gene_profiles(df: pd.DataFrame, fit_results: dict,
+        xmin: int=-50, xmax: int=1000, n_clusters: int=4, bin_size: int=10,
+        n_components: int=10, center: bool=True, seed: int=None):
+    """
+    Group genes by the shape of their phasing profiles
+
+    The residuals of every gene against the population fit_function curve
+    are averaged into position bins, giving a gene x bin matrix. Its
+    leading components come from a randomized truncated SVD and the genes
+    are clustered in that space with mini-batch k-means.
+
+    Parameters:
+    -----------
+    df : pandas.DataFrame
+        Input dataframe containing methylation data
+        Must have columns: 'Gene', 'Pos', 'Value'
+    fit_results:
+        Fitting result from phasing analysis
+    xmin : int
+        Minimum x value to include in analysis
+    xmax : int
+        Maximum x value to include in analysis
+    n_clusters : int
+        Number of clusters
+    bin_size : int
+        Number of bp averaged into one bin
+    n_components : int
+        Number of SVD components used for clustering
+    center : bool
+        Remove each gene's adjusted average first, so genes are grouped by
+        profile shape rather than by level
+    seed : int
+        Seed of the random projections and of k-means
+
+    Returns:
+    --------
+    tuple
+        (cluster_pd, profile_pd)
+        cluster_pd: columns 'Gene', 'Cluster', 'PC1', 'PC2'
+        profile_pd: average profile of each cluster with columns
+        'Cluster', 'Pos', 'Residual', 'Value', 'Genes'
+    """
+    model, fit_params = population_model(fit_results)
+    # Ensure required columns exist
+    required_columns = ['Gene', 'Pos', 'Value']
+    if not all(col in df.columns for col in required_columns):
+        st.error("CSV must contain columns: 'Gene', 'Pos', 'Value'")
+        return None
+
+    try:
+        genes, positions, matrix = build_gene_matrix(df, xmin=xmin, xmax=xmax)
+        if len(genes) < n_clusters:
+            st.error(f"Clustering needs at least {n_clusters} genes, found {len(genes)}")
+            return None
+        resid, adj_rate, _, _ = calculate_adj_gene_matrix(positions, matrix, fit_params, model)
+        del matrix
+        bin_pos, binned = bin_gene_matrix(positions, resid, bin_size=bin_size)
+        del resid
+
+        # Missing bins follow the population curve (zero residual)
+        features = binned - adj_rate[:, None] if center else binned.copy()
+        features[np.isnan(features)] = 0.0
+        features -= features.mean(axis=0)
+        rng = np.random.default_rng(seed)
+        U, S, _ = _randomized_svd(features, n_components, rng=rng)
+        scores = U * S
+        _, labels, _ = _minibatch_kmeans(scores, n_clusters, rng=rng)
+
+        # Number clusters by decreasing size
+        sizes = np.bincount(labels, minlength=n_clusters)
+        rank = np.empty(n_clusters, dtype=int)
+        rank[np.argsort(-sizes, kind='stable')] = np.arange(n_clusters)
+        labels = rank[labels]
+        sizes = np.bincount(labels, minlength=n_clusters)
+
+        # Average residual profile per cluster, ignoring missing bins
+        valid = ~np.isnan(binned)
+        one_hot = np.eye(n_clusters)[labels]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean_resid = (one_hot.T @ np.where(valid, binned, 0.0)) / (one_hot.T @ valid)
+        y_fit = FIT_MODELS[model]['function'](bin_pos, *fit_params)
+
+        cluster_pd = pd.DataFrame({
+            'Gene': genes,
+            'Cluster': labels,
+            'PC1': scores[:, 0],
+            'PC2': scores[:, 1] if scores.shape[1] > 1 else 0.0,
+        })
+        profile_pd = pd.DataFrame({
+            'Cluster': np.repeat(np.arange(n_clusters), len(bin_pos)),
+            'Pos': np.tile(bin_pos, n_clusters),
+            'Residual': mean_resid.ravel(),
+            'Value': (mean_resid + y_fit).ravel(),
+            'Genes': np.repeat(sizes, len(bin_pos)),
+        })
+        return cluster_pd, profile_pd
+
+    except Exception as e:
+        st.error(f"Profile clustering failed: {str(e)}")
+        return None
+
+
+def heatmap_row_order(gene_df: pd.DataFrame, genes, sort_by: str='Adj.Average',
+        ascending: bool=False):
+    """
+    Rows of a gene matrix in heatmap order
+
+    Parameters:
+    -----------
+    gene_df : pandas.DataFrame
+        Gene table with a 'Gene' column and the sort column; sorting by
+        'Cluster' orders genes by Adj.Average within each cluster
+    genes : array-like
+        Gene of each matrix row (from build_gene_matrix)
+    sort_by : str
+        Column to sort by
+    ascending : bool
+        Sort order (NaN last)
+
+    Returns:
+    --------
+    numpy.ndarray
+        Matrix row indices, first row on top; genes missing from gene_df
+        are dropped
+    """
+    if sort_by == 'Cluster':
+        ordered = gene_df.sort_values(['Cluster', 'Adj.Average'], ascending=[True, ascending],
+                                      na_position='last', kind='stable')
+    else:
+        ordered = gene_df.sort_values(sort_by, ascending=ascending,
+                                      na_position='last', kind='stable')
+    rows = pd.Index(genes).get_indexer(ordered['Gene'])
+    return rows[rows >= 0]
+
+
+def build_heatmap_pyramid(matrix, rows=None, factor: int=2, min_rows: int=64,
+        min_cols: int=512):
+    """
+    Multi-resolution pyramid of a gene x position matrix
+
+    Level 0 holds the rows in heatmap order at full resolution (float32).
+    Each next level averages factor x factor blocks of the previous one,
+    skipping an axis once another step would take it below its minimum
+    size, until both axes are done.
+    Columns keep more resolution than rows since a display is usually
+    much shorter than the gene list but about as wide as the positions.
+
+    Parameters:
+    -----------
+    matrix : numpy.ndarray
+        Gene x position values (NaN where missing)
+    rows : array-like
+        Row order (from heatmap_row_order); all rows if None
+    factor : int
+        Block size between consecutive levels
+    min_rows, min_cols : int
+        Approximate size of the coarsest level along each axis
+
+    Returns:
+    --------
+    list
+        One dict per level, finest first, with 'data', 'row_step' and
+        'col_step' (rows / columns of level 0 per cell)
+    """
+    level = matrix if rows is None else matrix[rows]
+    pyramid = [{'data': level.astype(np.float32), 'row_step': 1, 'col_step': 1}]
+    while True:
+        row_size = factor if level.shape[0] > min_rows else 1
+        col_size = factor if level.shape[1] >= factor * min_cols else 1
+        if row_size == col_size == 1:
+            break
+        level = _block_mean(pyramid[-1]['data'], row_size, col_size)
+        pyramid.append({'data': level.astype(np.float32),
+                        'row_step': pyramid[-1]['row_step'] * row_size,
+                        'col_step': pyramid[-1]['col_step'] * col_size})
+    return pyramid
+
+
+def select_heatmap_tile(pyramid, row_start: int=0, row_stop: int=None,
+        max_rows: int=800, max_cols: int=1200):
+    """
+    Cut the rows [row_start, row_stop) of the finest pyramid level that
+    fits the display
+
+    Parameters:
+    -----------
+    pyramid : list
+        Output of build_heatmap_pyramid
+    row_start, row_stop : int
+        Row range of level 0 to show (row_stop None: last row)
+    max_rows, max_cols : int
+        Display size in cells, e.g. the figure size in pixels
+
+    Returns:
+    --------
+    dict
+        'data' (the tile), 'level', 'row_step', 'col_step', and the level 0
+        rows it covers as 'row_start' and 'row_stop'
+    """
+    n_rows = pyramid[0]['data'].shape[0]
+    row_stop = n_rows if row_stop is None else min(row_stop, n_rows)
+    for level, entry in enumerate(pyramid):
+        first = row_start // entry['row_step']
+        last = int(np.ceil(row_stop / entry['row_step']))
+        if (last - first <= max_rows and entry['data'].shape[1] <= max_cols) \
+                or level == len(pyramid) - 1:
+            break
+    return {
+        'data': entry['data'][first:last],
+        'level': level,
+        'row_step': entry['row_step'],
+        'col_step': entry['col_step'],
+        'row_start': first * entry['row_step'],
+        'row_stop': min(last * entry['row_step'], n_rows),
+    }
+
+
+def _average_profile(df):
+    """
+    Average Value per bp on a regular Pos grid, interpolating any gaps
+    """
+    pos = df['Pos'].values.astype(int)
+    xmin, xmax = pos.min(), pos.max()
+    grid = np.arange(xmin, xmax + 1)
+    sums = np.bincount(pos - xmin, weights=df['Value'].values, minlength=len(grid))
+    counts = np.bincount(pos - xmin, minlength=len(grid))
+    has_data = counts > 0
+    y = np.interp(grid, grid[has_data], sums[has_data] / counts[has_data])
+    return grid, y
+
+
+def calc_local_spacing(df: pd.DataFrame, result_dict: dict=None,
+        window: int=400, step: int=20, min_spacing: float=100,
+        max_spacing: float=300):
+    """
+    Sliding-window local spacing, amplitude and phase along Pos
+
+    The profile is averaged per bp, detrended against the fitted baseline
+    (b0 + slope * x) when a fit is given, and every window is transformed
+    in a single short-time FFT. Window means are taken from a running sum,
+    so no window is refitted.
+
+    Parameters:
+    -----------
+    df : pandas.DataFrame
+        Processed dataframe with columns: 'Pos', 'Value'
+    result_dict : dict
+        Fitting result from calc_sine_fit (optional)
+    window : int
+        Window length (bp)
+    step : int
+        Distance between consecutive window starts (bp)
+    min_spacing, max_spacing : float
+        Range of nucleosome spacings (bp) searched for the spectral peak
+
+    Returns:
+    --------
+    local_pd: pandas.DataFrame
+        Output dataframe with columns: 'Pos', 'Window.Start', 'Window.End',
+        'Spacing', 'Amplitude', 'Phase', 'Power.Fraction'
+    """
+    try:
+        grid, y = _average_profile(df)
+        if result_dict is not None:
+            b_fit, s_fit = result_dict['fit_params'][-2:]
+            y = y - (b_fit + s_fit * grid)
+
+        window = min(window, len(grid))
+        starts = np.arange(0, len(grid) - window + 1, step)
+        # Running sum gives every window mean in O(n)
+        csum = np.concatenate(([0.0], np.cumsum(y)))
+        win_mean = (csum[starts + window] - csum[starts]) / window
+
+        segments = np.lib.stride_tricks.sliding_window_view(y, window)[starts]
+        taper = np.hanning(window)
+        n_fft = 1 << int(np.ceil(np.log2(4 * window)))
+        freqs = np.fft.rfftfreq(n_fft)
+        band = np.flatnonzero((freqs >= 1 / max_spacing) & (freqs <= 1 / min_spacing))
+        coef = np.fft.rfft((segments - win_mean[:, None]) * taper, n=n_fft, axis=1)
+        spec = np.abs(coef)**2
+
+        peak_idx, peak_freq, _ = _spectral_peak(spec, freqs, band)
+        rows = np.arange(len(starts))
+        amplitude = 2 * np.abs(coef[rows, peak_idx]) / taper.sum()
+        # Phase referenced to Pos = 0, matching theta0 of fit_function
+        w_local = 2 * np.pi * peak_freq
+        x_start = grid[starts]
+        phase = np.angle(coef[rows, peak_idx]) + np.pi / 2 - w_local * x_start
+        phase = np.angle(np.exp(1j * phase))
+        # Fraction of window power within one native bin of the peak
+        half_width = max(n_fft // window, 1)
+        cum = np.cumsum(spec, axis=1)
+        lo = np.maximum(peak_idx - half_width, 1)
+        hi = np.minimum(peak_idx + half_width, spec.shape[1] - 1)
+        power_fraction = (cum[rows, hi] - cum[rows, lo - 1]) / (cum[:, -1] - cum[:, 0])
+
+        local_pd = pd.DataFrame({
+            'Pos': x_start + (window - 1) / 2,
+            'Window.Start': x_start,
+            'Window.End': x_start + window - 1,
+            'Spacing': 1 / peak_freq,
+            'Amplitude': amplitude,
+            'Phase': phase,
+            'Power.Fraction': power_fraction,
+        })
+        return local_pd
+
+    except Exception as e:
+        st.error(f"Local spacing analysis failed: {str(e)}")
+        return None
+
+
+def _projection_r2(Y, basis_q, sst):
+    """
+    Best variable-projection R2 over a stack of orthonormal bases
+
+    Y has one profile per row, basis_q has shape (n_grid, n_pos, k) and
+    sst holds the total sum of squares of each row. The projection of all
+    profiles onto all bases is a single einsum.
+    """
+    proj = np.einsum('sn,gnk->sgk', Y, basis_q)
+    ss_model = np.sum(proj**2, axis=2) - Y.sum(axis=1, keepdims=True)**2 / Y.shape[1]
+    return np.max(ss_model, axis=1) / sst
+
+
+def calc_phasing_significance(df: pd.DataFrame, result_dict: dict,
+        n_surrogates: int=1000, method: str='phase', n_grid: int=41,
+        min_spacing: float=100, max_spacing: float=300, batch_size: int=250,
+        seed: int=None):
+    """
+    Surrogate test for the significance of the phasing signal
+
+    The test statistic is the variable-projection R2 of the decaying sine
+    model: for the fitted decay constant and a grid of spacings, the model
+    is linear in (A cos(theta0), A sin(theta0), b, s), so the best R2 of
+    every surrogate is obtained from one batched projection instead of a
+    curve_fit per surrogate.
+
+    Parameters:
+    -----------
+    df : pandas.DataFrame
+        Processed dataframe with columns: 'Pos', 'Value'
+    result_dict : dict
+        Fitting result from calc_sine_fit
+    n_surrogates : int
+        Number of surrogate profiles (controls runtime)
+    method : str
+        'phase' for phase-randomized surrogates (keeps the power spectrum)
+        or 'permutation' for shuffled residuals
+    n_grid : int
+        Number of spacings in [min_spacing, max_spacing] searched per profile
+    batch_size : int
+        Number of surrogates evaluated at once
+    seed : int
+        Seed of the random generator
+
+    Returns:
+    --------
+    dict
+        Dictionary with 'P_value', 'Stat_R2', 'Null_R2_95', 'N_surrogates'
+        and 'Method'
+    """
+    if method not in ('phase', 'permutation'):
+        st.error(f"Unknown surrogate method: {method}")
+        return None
+
+    try:
+        grid, y = _average_profile(df)
+        x = grid.astype(float)
+        l_fit = max(result_dict['fit_params'][1], 0.0)
+
+        # Orthonormal bases of the linearized model for each trial spacing
+        w_grid = 2 * np.pi / np.linspace(min_spacing, max_spacing, n_grid)
+        envelope = np.exp(-l_fit * x)
+        basis = np.stack([
+            envelope * np.sin(np.outer(w_grid, x)),
+            envelope * np.cos(np.outer(w_grid, x)),
+            np.broadcast_to(np.ones_like(x), (n_grid, len(x))),
+            np.broadcast_to(x, (n_grid, len(x))),
+        ], axis=2)
+        basis_q = np.linalg.qr(basis)[0]
+
+        # Surrogates are built from the residual of a linear trend
+        trend = np.polyval(np.polyfit(x, y, 1), x)
+        resid = y - trend
+        sst = np.sum((y - y.mean())**2)
+        stat = _projection_r2(y[None, :], basis_q, np.array([sst]))[0]
+
+        rng = np.random.default_rng(seed)
+        amplitude = np.abs(np.fft.rfft(resid))
+        null = np.empty(n_surrogates)
+        for start in range(0, n_surrogates, batch_size):
+            n_batch = min(batch_size, n_surrogates - start)
+            if method == 'phase':
+                phases = rng.uniform(0, 2 * np.pi, (n_batch, len(amplitude)))
+                phases[:, 0] = 0
+                if len(x) % 2 == 0:
+                    phases[:, -1] = 0
+                surr = np.fft.irfft(amplitude * np.exp(1j * phases), n=len(x), axis=1)
+            else:
+                surr = rng.permuted(np.broadcast_to(resid, (n_batch, len(x))), axis=1)
+            surr = surr + trend
+            surr_sst = np.sum((surr - surr.mean(axis=1, keepdims=True))**2, axis=1)
+            null[start:start + n_batch] = _projection_r2(surr, basis_q, surr_sst)
+
+        return {
+            'P_value': (1 + np.sum(null >= stat)) / (1 + n_surrogates),
+            'Stat_R2': stat,
+            'Null_R2_95': np.quantile(null, 0.95),
+            'N_surrogates': n_surrogates,
+            'Method': method,
+        }
+
+    except Exception as e:
+        st.error(f"Significance test failed: {str(e)}")
+        return None
+
+
+# File types accepted by the upload widgets
+UPLOAD_TYPES = ['csv', 'parquet', 'arrow', 'feather', 'ipc']
+
+# Column types used for typed reads
+COLUMN_TYPES = {'Gene': 'string', 'Pos': 'float64', 'Value': 'float64'}
+
+
+def read_phasing_table(source, columns=('Pos', 'Value'), location_range=None,
+        file_name=None):
+    """
+    Read a CSV, Parquet, Arrow IPC or Feather table with projected columns
+
+    Only the requested columns are read. For Parquet the location_range
+    filter is pushed down to the row groups; CSV files are parsed with a
+    typed, multi-threaded reader.
+
+    Parameters:
+    -----------
+    source : str or file-like
+        Path or uploaded file
+    columns : sequence
+        Columns to read, e.g. ('Pos', 'Value') or ('Gene', 'Pos', 'Value')
+    location_range : list
+        Optional [xmin, xmax] filter on Pos
+    file_name : str
+        Name used to detect the format (default: the path or source.name)
+
+    Returns:
+    --------
+    pandas.DataFrame
+        Table with the requested columns
+    """
+    if file_name is None:
+        file_name = source if isinstance(source, str) else getattr(source, 'name', '')
+    ext = str(file_name).rsplit('.', 1)[-1].lower()
+    columns = list(columns)
+
+    try:
+        if ext == 'parquet':
+            filters = None
+            if location_range is not None:
+                filters = [('Pos', '>=', location_range[0]),
+                           ('Pos', '<=', location_range[1])]
+            table = pq.read_table(source, columns=columns, filters=filters)
+        elif ext in ('arrow', 'feather', 'ipc'):
+            table = feather.read_table(source, columns=columns)
+        else:
+            table = pv.read_csv(
+                source,
+                read_options=pv.ReadOptions(use_threads=True),
+                convert_options=pv.ConvertOptions(
+                    include_columns=columns,
+                    column_types={col: pa.type_for_alias(COLUMN_TYPES[col])
+                                  for col in columns if col in COLUMN_TYPES}))
+        if location_range is not None and ext != 'parquet':
+            pos = table.column('Pos')
+            table = table.filter(pc.and_(pc.greater_equal(pos, location_range[0]),
+                                         pc.less_equal(pos, location_range[1])))
+        return table.to_pandas()
+
+    except Exception as e:
+        st.error(f"Error reading {file_name} (required columns: "
+                 f"{', '.join(columns)}): {str(e)}")
+        return None
+
+
+def _source_size(source):
+    """
+    Size in bytes of a path or seekable file-like object
+    """
+    if isinstance(source, str):
+        return os.path.getsize(source)
+    source.seek(0, os.SEEK_END)
+    size = source.tell()
+    source.seek(0)
+    return size
+
+
+def validate_upload(source, columns=('Pos', 'Value'), location_range=None,
+        file_name=None, sample_bytes: int=1 << 20, large_mb: float=500):
+    """
+    Validate an upload from its header and a streamed sample of rows
+
+    Parquet and Arrow/Feather files are checked from their metadata and the
+    first record batch; CSV files from the first sample_bytes only. The row
+    count, gene count and in-memory size of the full table are estimated
+    from the sample so large files can be routed to the chunked path.
+
+    Parameters:
+    -----------
+    source : str or file-like
+        Path or uploaded file
+    columns : sequence
+        Required columns
+    location_range : list
+        Optional [xmin, xmax] expected to overlap the sampled positions
+    file_name : str
+        Name used to detect the format (default: the path or source.name)
+    sample_bytes : int
+        Number of bytes of a CSV file read for the sample
+    large_mb : float
+        Estimated in-memory size (MB) above which 'large' is set
+
+    Returns:
+    --------
+    dict
+        Report with 'valid', 'errors', 'warnings', 'n_rows', 'rows_exact',
+        'n_genes', 'pos_range', 'memory_mb' and 'large'
+    """
+    if file_name is None:
+        file_name = source if isinstance(source, str) else getattr(source, 'name', '')
+    ext = str(file_name).rsplit('.', 1)[-1].lower()
+    columns = list(columns)
+    report = {'valid': False, 'errors': [], 'warnings': [], 'n_rows': 0,
+              'rows_exact': False, 'n_genes': None, 'pos_range': None,
+              'memory_mb': 0.0, 'large': False}
+
+    try:
+        size = _source_size(source)
+        if ext == 'parquet':
+            pf = pq.ParquetFile(source)
+            header = pf.schema_arrow.names
+            n_rows, exact = pf.metadata.num_rows, True
+            usable = [col for col in columns if col in header]
+            batch = next(pf.iter_batches(batch_size=10000, columns=usable), None)
+            sample = batch.to_pandas() if batch is not None else pd.DataFrame(columns=usable)
+        elif ext in ('arrow', 'feather', 'ipc'):
+            reader = ipc.open_file(source)
+            header = reader.schema.names
+            n_rows = sum(reader.get_batch(i).num_rows
+                         for i in range(reader.num_record_batches))
+            exact = True
+            usable = [col for col in columns if col in header]
+            sample = (reader.get_batch(0).select(usable).to_pandas()
+                      if reader.num_record_batches > 0 else pd.DataFrame(columns=usable))
+        else:
+            if isinstance(source, str):
+                with open(source, 'rb') as fh:
+                    head = fh.read(sample_bytes)
+            else:
+                head = source.read(sample_bytes)
+            if len(head) < size:
+                # Drop the trailing partial line of the sample
+                head = head[:head.rfind(b'\n') + 1]
+            header = pd.read_csv(io.BytesIO(head), nrows=0).columns.tolist()
+            usable = [col for col in columns if col in header]
+            sample = pd.read_csv(io.BytesIO(head), usecols=usable)
+            n_rows = int(round(len(sample) * size / max(len(head), 1)))
+            exact = len(head) >= size
+        if not isinstance(source, str):
+            source.seek(0)
+    except Exception as e:
+        report['errors'].append(f"Could not read file header: {str(e)}")
+        return report
+
+    missing = [col for col in columns if col not in header]
+    if missing:
+        report['errors'].append(f"Missing required columns: {', '.join(missing)}")
+        return report
+
+    # Column types
+    for col in ('Pos', 'Value'):
+        if col in columns:
+            values = pd.to_numeric(sample[col], errors='coerce')
+            n_bad = int(values.isna().sum() - sample[col].isna().sum())
+            if n_bad > 0:
+                report['errors'].append(f"Column '{col}' has non-numeric values "
+                                        f"({n_bad} of {len(sample)} sampled rows)")
+            elif col == 'Pos' and len(values) > 0:
+                report['pos_range'] = [float(values.min()), float(values.max())]
+    if len(sample) == 0:
+        report['errors'].append("File contains no data rows")
+
+    # Position range
+    if report['pos_range'] is not None and location_range is not None:
+        lo, hi = report['pos_range']
+        if hi < location_range[0] or lo > location_range[1]:
+            report['warnings'].append(
+                f"Sampled positions {lo:.0f}..{hi:.0f} lie outside the analysis "
+                f"range {location_range[0]}..{location_range[1]}")
+
+    # Gene count and memory estimate
+    scale = n_rows / max(len(sample), 1)
+    mem_bytes = sample.memory_usage(index=False, deep=True).sum() * scale
+    if 'Gene' in columns and len(sample) > 0:
+        n_genes = sample['Gene'].nunique()
+        report['n_genes'] = n_genes if len(sample) >= n_rows else int(round(n_genes * scale))
+
+    report.update({
+        'valid': not report['errors'],
+        'n_rows': int(n_rows),
+        'rows_exact': exact,
+        'memory_mb': float(mem_bytes) / 2**20,
+        'large': float(mem_bytes) / 2**20 > large_mb,
+    })
+    return report
+
+
+def show_upload_report(report, show_size: bool=True, allow_large: bool=True):
+    """
+    Show the errors, warnings and size estimate of an upload report
+
+    Parameters:
+    -----------
+    report : dict
+        Report returned by validate_upload
+    show_size : bool
+        Whether to show the estimated row count, gene count and memory size
+    allow_large : bool
+        Whether large uploads can be used; per-gene analyses need the whole
+        table in memory and refuse them
+
+    Returns:
+    --------
+    bool
+        Whether the upload is valid (and, unless allowed, not large)
+    """
+    for error in report['errors']:
+        st.error(error)
+    if not report['valid']:
+        return False
+    if report['large'] and not allow_large:
+        st.error(f"The file needs ~{report['memory_mb']:,.0f} MB in memory, more than "
+                 "per-gene analysis can load. Upload only the genes or positions of "
+                 "interest, or use Phasing Analysis for the population profile.")
+        return False
+    for warning in report['warnings']:
+        st.warning(warning)
+    if show_size:
+        approx = '' if report['rows_exact'] else '~'
+        genes = '' if report['n_genes'] is None else f"~{report['n_genes']:,} genes, "
+        st.caption(f"{approx}{report['n_rows']:,} rows, {genes}"
+                   f"~{report['memory_mb']:.0f} MB in memory")
+    return True
+
+
+def read_aggregated_table(source, location_range, file_name=None,
+        chunk_rows: int=1_000_000):
+    """
+    Stream a large Pos/Value table into per-position means chunk by chunk
+
+    CSV files are read in chunks of chunk_rows, Parquet files in record
+    batches of the Pos and Value columns and Arrow/Feather files one
+    record batch at a time, so only one chunk is held in memory.
+
+    Returns:
+    --------
+    pandas.DataFrame
+        Columns: 'Pos', 'Value', 'Count' (as from aggregate_profile)
+    """
+    if file_name is None:
+        file_name = source if isinstance(source, str) else getattr(source, 'name', '')
+    ext = str(file_name).rsplit('.', 1)[-1].lower()
+    xmin, xmax = int(location_range[0]), int(location_range[1])
+
+    try:
+        if ext == 'parquet':
+            chunks = (batch.to_pandas() for batch in pq.ParquetFile(source).iter_batches(
+                batch_size=chunk_rows, columns=['Pos', 'Value']))
+        elif ext in ('arrow', 'feather', 'ipc'):
+            reader = ipc.open_file(source)
+            chunks = (reader.get_batch(i).select(['Pos', 'Value']).to_pandas()
+                      for i in range(reader.num_record_batches))
+        else:
+            chunks = pd.read_csv(source, usecols=['Pos', 'Value'],
+                                 dtype={'Pos': 'float64', 'Value': 'float64'},
+                                 chunksize=chunk_rows)
+
+        sums = np.zeros(xmax - xmin + 1)
+        counts = np.zeros(xmax - xmin + 1)
+        for chunk in chunks:
+            pos = chunk['Pos'].to_numpy(dtype=float)
+            value = chunk['Value'].to_numpy(dtype=float)
+            mask = (pos >= xmin) & (pos <= xmax) & ~np.isnan(value)
+            idx = pos[mask].astype(int) - xmin
+            sums += np.bincount(idx, weights=value[mask], minlength=len(sums))
+            counts += np.bincount(idx, minlength=len(counts))
+        has_data = counts > 0
+        return pd.DataFrame({
+            'Pos': np.arange(xmin, xmax + 1)[has_data],
+            'Value': sums[has_data] / counts[has_data],
+            'Count': counts[has_data].astype(int),
+        })
+
+    except Exception as e:
+        st.error(f"Error reading {file_name}: {str(e)}")
+        return None
+
+
+def dataframe_to_parquet_bytes(df: pd.DataFrame):
+    """
+    Serialize a DataFrame to Parquet bytes for download
+    """
+    buf = io.BytesIO()
+    df.to_parquet(buf, index=False)
+    return buf.getvalue()
+
+
+def _json_safe(value):
+    """Convert one value to Python native types, with NaN and inf as None"""
+    if isinstance(value, dict):
+        return {key: _json_safe(v) for key, v in value.items()}
+    if isinstance(value, (list, tuple, np.ndarray)):
+        return [_json_safe(v) for v in value]
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, float) and not np.isfinite(value):
+        return None
+    return value
+
+
+def prepare_results_for_json(result_dict):
+    """
+    Convert numpy values to Python native types for JSON serialization
+
+    Nested dicts, lists and arrays are converted too, and non-finite
+    floats become None (null), so the output passes json.dumps with
+    allow_nan=False.
+    """
+    return _json_safe(result_dict)
+
+
 def get_plot_defaults():
     """
     Return default plot parameters